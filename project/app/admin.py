@@ -4,6 +4,7 @@ from django.contrib.auth.admin import UserAdmin
 from .forms import *
 from django.utils.safestring import mark_safe
 from django.contrib.sites.models import Site
+from .search import filter_news
 
 class PersonAdmin(UserAdmin):
     form = PersonChangeForm
@@ -35,8 +36,9 @@ admin.site.register(Category)
 
 @admin.register(News)
 class NewsAdmin(admin.ModelAdmin):
-    list_display = ['title', 'news_text', 'category', 'get_news_image']
-    search_fields = ('title', 'category')
+    list_display = ['title', 'news_text', 'category', 'views_count', 'get_news_image']
+    list_select_related = ['category']
+    search_fields = ('title',)
     fields = ['title', 'news_text', 'category', 'news_posted_at', 'news_image','get_news_image']
     readonly_fields = ['get_news_image', 'news_posted_at']
 
@@ -46,10 +48,16 @@ class NewsAdmin(admin.ModelAdmin):
         
     get_news_image.short_description = 'Загруженное фото'
 
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        return filter_news(queryset, search_term), False
+
 
 @admin.register(Comment)
 class CommentAdmin(admin.ModelAdmin):
     list_display = ['author', 'comment_text', 'comment_to_news', 'get_author_image']
+    list_select_related = ['author', 'comment_to_news']
 
 
     def get_author_image(self, obj):
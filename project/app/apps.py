@@ -1,6 +1,24 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        from . import signals
+
+        if settings.METRICS_ENABLED or settings.PROFILING_ENABLED:
+            from django.db.backends.signals import connection_created
+            from .metrics import install_query_recorder, instrument_templates
+
+            connection_created.connect(install_query_recorder, dispatch_uid='app.metrics')
+            if settings.METRICS_ENABLED:
+                instrument_templates()
+
+        if settings.SLOW_QUERY_LOG_ENABLED:
+            from django.db.backends.signals import connection_created
+            from .querylog import install_slow_query_log
+
+            connection_created.connect(install_slow_query_log, dispatch_uid='app.querylog')
@@ -0,0 +1,41 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.db import DEFAULT_DB_ALIAS
+
+from .cache import get_cached_user
+from .routers import primary
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend reading users from the cache. AuthenticationMiddleware loads
+    request.user through get_user() on every authenticated request; the entry
+    is dropped by app.signals whenever the user is saved or deleted.
+
+    The entry holds every field but the password, and the session hash
+    derived from it, which is all AuthenticationMiddleware checks. The
+    password is a deferred field of the user built from it: read from the
+    database if something asks for it, and left alone by save().
+    """
+
+    def load_user(self, user_id):
+        # From the primary, or a lagging replica could cache a user whose
+        # password or is_active just changed.
+        with primary():
+            user = super().get_user(user_id)
+        if user is None:
+            return None
+        fields = {
+            field.attname: getattr(user, field.attname)
+            for field in user._meta.concrete_fields if field.attname != 'password'
+        }
+        return {'fields': fields, 'session_auth_hash': user.get_session_auth_hash()}
+
+    def get_user(self, user_id):
+        entry = get_cached_user(user_id, self.load_user)
+        if entry is None:
+            return None
+        fields = entry['fields']
+        user = get_user_model().from_db(DEFAULT_DB_ALIAS, list(fields), list(fields.values()))
+        user.cached_session_auth_hash = entry['session_auth_hash']
+        return user if self.user_can_authenticate(user) else None
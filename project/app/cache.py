@@ -0,0 +1,261 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from .models import Category
+
+# Cached pages are keyed by version numbers kept in the cache. A version is
+# the time.time_ns() of the last change it tracks (or of when it was first
+# seeded), so an evicted version never comes back with a number that old
+# pages still use, and it doubles as a Last-Modified time.
+
+
+def _scope(category_id):
+    return 'all' if category_id is None else category_id
+
+
+def _list_version_key(category_id):
+    return f'news_list:{_scope(category_id)}:version'
+
+
+def _news_version_key(pk):
+    return f'news:{pk}:version'
+
+
+# The comment counts on the index cards. Comments bump it at most once per
+# COMMENT_COUNT_BUMP_DELAY seconds (bump_comment_counts), so the index is
+# not re-rendered for every comment yet never keeps a count for longer.
+COMMENT_COUNTS_VERSION_KEY = 'news_list:comment_counts:version'
+COMMENT_COUNTS_PENDING_KEY = 'news_list:comment_counts:pending'
+
+
+def _versions(*keys):
+    versions = cache.get_many(keys)
+    now = None
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        now = time.time_ns()
+        for key in missing:
+            cache.add(key, now, None)
+        versions.update(cache.get_many(missing))
+    return [versions.get(key, now) for key in keys]
+
+
+async def _aversions(*keys):
+    versions = await cache.aget_many(keys)
+    now = None
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        now = time.time_ns()
+        for key in missing:
+            await cache.aadd(key, now, None)
+        versions.update(await cache.aget_many(missing))
+    return [versions.get(key, now) for key in keys]
+
+
+def bump_versions(*keys):
+    cache.set_many(dict.fromkeys(keys, time.time_ns()), None)
+
+
+def _bump(*keys):
+    bump_versions(*keys)
+    if settings.DATABASE_REPLICAS:
+        # Pages a lagging replica served meanwhile went out with the new
+        # version; the second bump retires them (see app.routers).
+        from .task import rebump_versions
+        rebump_versions.apply_async(keys, countdown=settings.DATABASE_REPLICA_STICKY_SECONDS)
+
+
+def _validators(versions, user):
+    # The header differs per reader, so the user is part of the ETag.
+    etag = '"%s"' % '-'.join(str(part) for part in (*versions, user.pk or 0))
+    return etag, max(versions) // 10 ** 9
+
+
+def news_list_version(category_id=None):
+    """Current version of a news listing (None is the unfiltered one)."""
+    return _versions(_list_version_key(category_id))[0]
+
+
+async def anews_list_version(category_id=None):
+    return (await _aversions(_list_version_key(category_id)))[0]
+
+
+def _news_list_key(category_id, versions, cursor):
+    return f'news_list:{_scope(category_id)}:{"-".join(map(str, versions))}:{cursor or "first"}'
+
+
+def news_list_key(category_id=None, cursor=None):
+    versions = _versions(_list_version_key(category_id), COMMENT_COUNTS_VERSION_KEY)
+    return _news_list_key(category_id, versions, cursor)
+
+
+async def anews_list_key(category_id=None, cursor=None):
+    versions = await _aversions(_list_version_key(category_id), COMMENT_COUNTS_VERSION_KEY)
+    return _news_list_key(category_id, versions, cursor)
+
+
+def news_list_validators(category_id, user, *versions):
+    """
+    ETag and Last-Modified (epoch seconds) of a news index page, also
+    covering the versions of anything else shown on it.
+    """
+    keys = (_list_version_key(category_id), COMMENT_COUNTS_VERSION_KEY, categories.version_key)
+    return _validators([*_versions(*keys), *versions], user)
+
+
+async def anews_list_validators(category_id, user, *versions):
+    keys = (_list_version_key(category_id), COMMENT_COUNTS_VERSION_KEY, categories.version_key)
+    return _validators([*await _aversions(*keys), *versions], user)
+
+
+def news_validators(pk, user):
+    """ETag and Last-Modified (epoch seconds) of a news detail page."""
+    return _validators(_versions(_news_version_key(pk), categories.version_key), user)
+
+
+async def anews_validators(pk, user):
+    return _validators(await _aversions(_news_version_key(pk), categories.version_key), user)
+
+
+def invalidate_news_list(*category_ids):
+    """Drop every cached page of the given listings (None is the unfiltered one)."""
+    _bump(*{_list_version_key(category_id) for category_id in category_ids})
+
+
+def invalidate_news_pages(*pks):
+    """Mark the detail pages of the given news as changed."""
+    if pks:
+        _bump(*{_news_version_key(pk) for pk in pks})
+
+
+def invalidate_comment_counts():
+    """
+    Have the comment counts on the index refreshed within
+    COMMENT_COUNT_BUMP_DELAY seconds. The first comment of a window schedules
+    the bump; the ones after it are covered by the same bump.
+    """
+    if cache.add(COMMENT_COUNTS_PENDING_KEY, True, settings.COMMENT_COUNT_BUMP_DELAY * 2):
+        from .task import bump_comment_counts
+        bump_comment_counts.apply_async(countdown=settings.COMMENT_COUNT_BUMP_DELAY)
+
+
+def bump_comment_count_version():
+    # The pending flag goes first: a comment committed after the delete
+    # schedules the next bump, one committed before it is counted by the
+    # pages rendered under the new version.
+    cache.delete(COMMENT_COUNTS_PENDING_KEY)
+    _bump(COMMENT_COUNTS_VERSION_KEY)
+
+
+def _user_key(pk):
+    return f'user:{pk}'
+
+
+def get_cached_user(pk, load):
+    """The cache entry load(pk) makes for this user, loading it on a miss. Unknown and inactive users are not cached."""
+    user = cache.get(_user_key(pk))
+    if user is None:
+        user = load(pk)
+        if user is not None:
+            cache.set(_user_key(pk), user, settings.USER_CACHE_TIMEOUT)
+    return user
+
+
+def invalidate_user(pk):
+    cache.delete(_user_key(pk))
+
+
+class LookupTable:
+    """
+    Read-through cache of a small table that rarely changes.
+
+    Rows are always loaded from the primary database, as they are stored
+    under the current version. They are kept in two tiers: an LRU in this process, shared by every
+    table, in front of the default cache, where they are stored under the
+    table's version. invalidate() bumps the version, so other processes
+    (gunicorn and celery workers alike) see the change once their local
+    copy is LOOKUP_CACHE_LOCAL_TIMEOUT seconds old; until then a read costs
+    no cache round trip at all.
+    """
+
+    _local = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, name, queryset, timeout=None):
+        self.name = name
+        self.queryset = queryset
+        self.timeout = timeout
+        self.version_key = f'{name}:version'
+
+    def _local_get(self):
+        with self._lock:
+            entry = self._local.get(self.name)
+            if entry is not None:
+                self._local.move_to_end(self.name)
+            return entry
+
+    def _local_set(self, version, rows):
+        entry = (version, rows, {row.pk: row for row in rows}, time.monotonic() + settings.LOOKUP_CACHE_LOCAL_TIMEOUT)
+        with self._lock:
+            self._local[self.name] = entry
+            self._local.move_to_end(self.name)
+            while len(self._local) > settings.LOOKUP_CACHE_LOCAL_SIZE:
+                self._local.popitem(last=False)
+        return entry
+
+    def _entry(self):
+        entry = self._local_get()
+        if entry is not None and time.monotonic() < entry[3]:
+            return entry
+        version = _versions(self.version_key)[0]
+        if entry is not None and entry[0] == version:
+            return self._local_set(version, entry[1])
+        key = f'{self.name}:{version}'
+        rows = cache.get(key)
+        if rows is None:
+            rows = list(self.queryset.using(DEFAULT_DB_ALIAS))
+            cache.set(key, rows, self.timeout)
+        return self._local_set(version, rows)
+
+    async def _aentry(self):
+        entry = self._local_get()
+        if entry is not None and time.monotonic() < entry[3]:
+            return entry
+        version = (await _aversions(self.version_key))[0]
+        if entry is not None and entry[0] == version:
+            return self._local_set(version, entry[1])
+        key = f'{self.name}:{version}'
+        rows = await cache.aget(key)
+        if rows is None:
+            rows = [row async for row in self.queryset.using(DEFAULT_DB_ALIAS)]
+            await cache.aset(key, rows, self.timeout)
+        return self._local_set(version, rows)
+
+    def all(self):
+        return self._entry()[1]
+
+    async def aall(self):
+        return (await self._aentry())[1]
+
+    def get(self, pk):
+        """The row with this primary key, or None."""
+        return self._entry()[2].get(pk)
+
+    async def aget(self, pk):
+        return (await self._aentry())[2].get(pk)
+
+    def invalidate(self):
+        with self._lock:
+            self._local.pop(self.name, None)
+        _bump(self.version_key)
+
+
+categories = LookupTable('categories', Category.objects.all(), settings.NEWS_LIST_CACHE_TIMEOUT)
+get_categories = categories.all
+aget_categories = categories.aall
+invalidate_categories = categories.invalidate
@@ -0,0 +1,137 @@
+import posixpath
+from io import BytesIO
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+# Widths of the resized copies kept next to every uploaded image, per field.
+# Copies never upscale, so a variant of a small upload may be narrower than
+# its nominal width.
+IMAGE_VARIANT_WIDTHS = {
+    'app.News.news_image': (320, 640, 1280),
+    'app.User.image': (100, 200, 320),
+}
+
+VARIANT_FORMATS = (
+    ('WEBP', 'webp', 'image/webp'),
+    ('JPEG', 'jpg', 'image/jpeg'),
+)
+
+VARIANT_QUALITY = 80
+
+# How long to wait before looking for the variants of an image again.
+MISSING_VARIANTS_TIMEOUT = 60
+
+
+def variant_widths(image):
+    """Variant widths configured for a FieldFile, empty if it has none."""
+    field = image.field
+    return IMAGE_VARIANT_WIDTHS.get(f'{field.model._meta.label}.{field.name}', ())
+
+
+def variant_name(name, width, extension):
+    stem, _ = posixpath.splitext(name)
+    return posixpath.join('variants', f'{stem}_{width}.{extension}')
+
+
+def variants_ready(name, widths, storage=default_storage):
+    # The largest JPEG is written last, so it existing means all of them do.
+    return storage.exists(variant_name(name, max(widths), VARIANT_FORMATS[-1][1]))
+
+
+def _ready_key(name):
+    return f'image_variants:{name}'
+
+
+def _read_widths(name, widths, storage):
+    """Actual width of each variant, by nominal width, from the JPEG headers."""
+    ready = {}
+    for width in widths:
+        with storage.open(variant_name(name, width, VARIANT_FORMATS[-1][1])) as file:
+            ready[width] = Image.open(file).width
+    return ready
+
+
+def _check_variants(name, widths, storage):
+    ready = _read_widths(name, widths, storage) if variants_ready(name, widths, storage) else {}
+    cache.set(_ready_key(name), ready, None if ready else MISSING_VARIANTS_TIMEOUT)
+    return ready
+
+
+def ready_variants(name, widths, storage=default_storage):
+    """
+    Actual width of each variant by nominal width, empty until they have all
+    been generated. generate_image_variants records them in the cache, so
+    storage is only asked again after an eviction, or every
+    MISSING_VARIANTS_TIMEOUT seconds while the variants are missing.
+    """
+    ready = cache.get(_ready_key(name))
+    return _check_variants(name, widths, storage) if ready is None else ready
+
+
+def _with_variants(images):
+    wanted = {}
+    for image in images:
+        widths = variant_widths(image) if image else ()
+        if widths:
+            wanted[image.name] = widths
+    return wanted
+
+
+def image_variants(images, storage=default_storage):
+    """
+    ready_variants() of every image on a page, by name, from one cache
+    lookup. Views pass it to their templates as ``image_variants``, which
+    the responsive_image tags read instead of looking up each image.
+    """
+    wanted = _with_variants(images)
+    found = cache.get_many([_ready_key(name) for name in wanted])
+    return {
+        name: found[_ready_key(name)] if _ready_key(name) in found else _check_variants(name, widths, storage)
+        for name, widths in wanted.items()
+    }
+
+
+async def aimage_variants(images, storage=default_storage):
+    wanted = _with_variants(images)
+    found = await cache.aget_many([_ready_key(name) for name in wanted])
+    variants = {}
+    for name, widths in wanted.items():
+        if _ready_key(name) in found:
+            variants[name] = found[_ready_key(name)]
+        else:
+            # Storage I/O, kept off the event loop.
+            variants[name] = await sync_to_async(_check_variants, thread_sensitive=False)(name, widths, storage)
+    return variants
+
+
+def generate_image_variants(name, widths, storage=default_storage):
+    """
+    Write every WebP/JPEG variant of the stored image, unless already done.
+    Returns whether anything was written.
+    """
+    if not widths or variants_ready(name, widths, storage):
+        return False
+    with storage.open(name) as file:
+        original = ImageOps.exif_transpose(Image.open(file))
+        original.load()
+    if original.mode not in ('RGB', 'RGBA'):
+        original = original.convert('RGBA')
+    ready = {}
+    for width in sorted(widths):
+        image = original.copy()
+        image.thumbnail((width, width * 10), Image.LANCZOS)
+        ready[width] = image.width
+        for format, extension, _ in VARIANT_FORMATS:
+            output = image.convert('RGB') if format == 'JPEG' else image
+            buffer = BytesIO()
+            output.save(buffer, format, quality=VARIANT_QUALITY)
+            path = variant_name(name, width, extension)
+            if storage.exists(path):
+                storage.delete(path)
+            storage.save(path, ContentFile(buffer.getvalue()))
+    cache.set(_ready_key(name), ready, None)
+    return True
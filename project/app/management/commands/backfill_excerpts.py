@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from app.cache import invalidate_news_list
+from app.models import Category, News, news_excerpt
+
+
+class Command(BaseCommand):
+    help = 'Fill News.excerpt for news saved before it existed, or for all news with --all.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Recompute every excerpt, not only the empty ones.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        queryset = News.objects.all() if options['all'] else News.objects.filter(excerpt='')
+        updated = 0
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk).order_by('pk').only('news_text')[:options['batch_size']])
+            if not batch:
+                break
+            for news in batch:
+                news.excerpt = news_excerpt(news.news_text)
+            News.objects.bulk_update(batch, ['excerpt'])
+            updated += len(batch)
+            last_pk = batch[-1].pk
+            self.stdout.write(f'{updated} news updated')
+
+        if updated:
+            # bulk_update sends no signals, so drop the cached index pages here.
+            invalidate_news_list(None, *Category.objects.values_list('pk', flat=True))
+        self.stdout.write(self.style.SUCCESS(f'Filled the excerpt of {updated} news.'))
@@ -0,0 +1,214 @@
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode, urljoin
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, Request, build_opener
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from app.models import Category, News
+
+CSRF_RE = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+
+# Share of the requests each scenario gets.
+SCENARIOS = {
+    'index': 40,
+    'filtered_index': 20,
+    'detail': 30,
+    'comment': 5,
+    'login': 5,
+}
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, math.ceil(percent * len(values) / 100) - 1))
+    return values[index]
+
+
+class NoRedirect(HTTPRedirectHandler):
+    # Time only the request itself, not the page a redirect leads to.
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Client:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirect())
+        self.logged_in = False
+
+    def request(self, path, data=None):
+        url = urljoin(self.base_url, path)
+        body = urlencode(data).encode() if data is not None else None
+        request = Request(url, data=body, headers={'Referer': url})
+        started = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                content = response.read().decode('utf-8', 'replace')
+                status = response.status
+        except HTTPError as error:
+            content, status = '', error.code
+        return status, time.perf_counter() - started, content
+
+    def csrf_token(self, path):
+        status, _, content = self.request(path)
+        match = CSRF_RE.search(content)
+        if not match:
+            raise CommandError(f'No CSRF token on {path} (HTTP {status})')
+        return match.group(1)
+
+    def login(self, email, password):
+        token = self.csrf_token(reverse('login'))
+        status, elapsed, _ = self.request(
+            reverse('login'), {'csrfmiddlewaretoken': token, 'email': email, 'password': password}
+        )
+        self.logged_in = status == 302
+        return status, elapsed
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive the main pages of a running server concurrently and report '
+        'p50/p95/p99 latency and throughput. Run seed_news first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('base_url', help='e.g. http://127.0.0.1:8000')
+        parser.add_argument('--requests', type=int, default=1000, help='Total number of timed requests.')
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--prefix', default='seed', help='Email prefix of the seeded users.')
+        parser.add_argument('--users', type=int, default=100, help='How many seeded users to log in as.')
+        parser.add_argument('--password', default='loadtest')
+        parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.base_url = options['base_url'].rstrip('/') + '/'
+        self.category_ids = list(Category.objects.values_list('pk', flat=True))
+        self.news_ids = list(News.objects.values_list('pk', flat=True)[:10000])
+        if not self.news_ids:
+            raise CommandError('No news in the database; run seed_news first.')
+
+        rng = random.Random(options['seed'])
+        names, weights = zip(*SCENARIOS.items())
+        plan = [(i, rng.choices(names, weights)[0], rng.random()) for i in range(options['requests'])]
+        self.local = threading.local()
+        self.results = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            list(executor.map(self.run, plan))
+        elapsed = time.perf_counter() - started
+
+        report = self.report(elapsed)
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.print_report(report)
+
+    def client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = Client(self.base_url)
+        return self.local.client
+
+    def run(self, step):
+        number, scenario, pick = step
+        client = self.client()
+        try:
+            status, elapsed = getattr(self, f'scenario_{scenario}')(client, number, pick)
+        except (URLError, OSError, CommandError):
+            with self.lock:
+                self.errors[scenario] += 1
+            return
+        with self.lock:
+            self.results[scenario].append(elapsed)
+            if status >= 400:
+                self.errors[scenario] += 1
+
+    def pick(self, items, pick):
+        return items[int(pick * len(items))]
+
+    def user_email(self, number):
+        return f"{self.options['prefix']}-{number % self.options['users']}@example.com"
+
+    def scenario_index(self, client, number, pick):
+        status, elapsed, _ = client.request(reverse('main'))
+        return status, elapsed
+
+    def scenario_filtered_index(self, client, number, pick):
+        if not self.category_ids:
+            return self.scenario_index(client, number, pick)
+        path = f"{reverse('main')}?{urlencode({'category': self.pick(self.category_ids, pick)})}"
+        status, elapsed, _ = client.request(path)
+        return status, elapsed
+
+    def scenario_detail(self, client, number, pick):
+        status, elapsed, _ = client.request(reverse('detail_news', kwargs={'pk': self.pick(self.news_ids, pick)}))
+        return status, elapsed
+
+    def scenario_login(self, client, number, pick):
+        # A fresh session, since a logged-in one gets no login form.
+        return Client(self.base_url).login(self.user_email(number), self.options['password'])
+
+    def scenario_comment(self, client, number, pick):
+        if not client.logged_in:
+            client.login(self.user_email(number), self.options['password'])
+        path = reverse('detail_news', kwargs={'pk': self.pick(self.news_ids, pick)})
+        token = client.csrf_token(path)
+        status, elapsed, _ = client.request(
+            path, {'csrfmiddlewaretoken': token, 'comment_text': f'Нагрузочный комментарий {number}'}
+        )
+        return status, elapsed
+
+    def report(self, elapsed):
+        scenarios = {}
+        everything = []
+        for scenario in SCENARIOS:
+            timings = sorted(self.results[scenario])
+            everything += timings
+            scenarios[scenario] = self.summary(timings, self.errors[scenario], elapsed)
+        total_errors = sum(self.errors.values())
+        return {
+            'base_url': self.base_url,
+            'concurrency': self.options['concurrency'],
+            'elapsed_s': round(elapsed, 3),
+            'total': self.summary(sorted(everything), total_errors, elapsed),
+            'scenarios': scenarios,
+        }
+
+    def summary(self, timings, errors, elapsed):
+        return {
+            'requests': len(timings),
+            'errors': errors,
+            'throughput_rps': round(len(timings) / elapsed, 2) if elapsed else 0.0,
+            'p50_ms': round(percentile(timings, 50) * 1000, 2),
+            'p95_ms': round(percentile(timings, 95) * 1000, 2),
+            'p99_ms': round(percentile(timings, 99) * 1000, 2),
+        }
+
+    def print_report(self, report):
+        self.stdout.write(
+            f"{report['total']['requests']} requests in {report['elapsed_s']}s "
+            f"with concurrency {report['concurrency']} against {report['base_url']}"
+        )
+        self.stdout.write(f"{'scenario':<16}{'requests':>9}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        rows = list(report['scenarios'].items()) + [('total', report['total'])]
+        for name, row in rows:
+            self.stdout.write(
+                f"{name:<16}{row['requests']:>9}{row['errors']:>8}{row['throughput_rps']:>9}"
+                f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}"
+            )
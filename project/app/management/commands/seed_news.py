@@ -0,0 +1,127 @@
+import random
+from datetime import timedelta
+from io import BytesIO
+
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from PIL import Image
+
+from app.cache import invalidate_categories, invalidate_news_list
+from app.images import IMAGE_VARIANT_WIDTHS, generate_image_variants
+from app.models import Category, Comment, News, User, news_excerpt
+from app.task import reconcile_comment_counts
+
+WORDS = (
+    'новости город страна мир спорт погода экономика политика наука культура '
+    'выборы рынок футбол матч дождь солнце президент министр закон школа '
+    'больница дорога мост театр кино музыка выставка космос ракета компьютер'
+).split()
+
+
+class Command(BaseCommand):
+    help = 'Fill the database with synthetic categories, news, users and comments for load testing.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=10)
+        parser.add_argument('--news', type=int, default=1000)
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--comments', type=int, default=10000)
+        parser.add_argument('--images', type=int, default=5, help='Distinct news images to generate.')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed, for reproducible data.')
+        parser.add_argument('--prefix', default='seed', help='Prefix of the generated user emails.')
+        parser.add_argument('--password', default='loadtest', help='Password of every generated user.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        now = timezone.now()
+
+        categories = Category.objects.bulk_create(
+            Category(name=f"{self.words(1).capitalize()} {i}") for i in range(options['categories'])
+        )
+        category_ids = [category.pk for category in categories] + [None]
+        images = self.create_images(options['images'])
+
+        news = (
+            News(
+                title=self.words(6).capitalize(),
+                news_text=text,
+                excerpt=news_excerpt(text),
+                news_image=self.random.choice(images),
+                category_id=self.random.choice(category_ids),
+                news_posted_at=now - timedelta(seconds=self.random.randint(0, 365 * 24 * 3600)),
+            )
+            for text in (self.words(self.random.randint(80, 400)).capitalize() for _ in range(options['news']))
+        )
+        self.bulk_create(News, news)
+
+        seeded_users = User.objects.filter(email__startswith=f"{options['prefix']}-")
+        existing_users = seeded_users.count()
+        password = make_password(options['password'])
+        users = (
+            User(
+                email=f"{options['prefix']}-{i}@example.com",
+                name=self.words(1).capitalize(),
+                password=password,
+                is_active=True,
+                activation_email_sent_at=now,
+            )
+            for i in range(options['users'])
+        )
+        self.bulk_create(User, users, ignore_conflicts=True)
+
+        # Users already seeded with this prefix were skipped by ignore_conflicts.
+        user_ids = list(seeded_users.values_list('pk', flat=True))
+        news_ids = list(News.objects.values_list('pk', flat=True))
+        comment_count = options['comments'] if user_ids and news_ids else 0
+        if comment_count:
+            comments = (
+                Comment(
+                    author_id=self.random.choice(user_ids),
+                    comment_text=self.words(self.random.randint(3, 40)).capitalize(),
+                    comment_to_news_id=self.random.choice(news_ids),
+                    comment_posted_at=now - timedelta(seconds=self.random.randint(0, 365 * 24 * 3600)),
+                )
+                for _ in range(options['comments'])
+            )
+            self.bulk_create(Comment, comments)
+
+        # bulk_create sends no signals, so count the comments and drop the
+        # cached index pages here.
+        reconcile_comment_counts()
+        invalidate_categories()
+        invalidate_news_list(*category_ids)
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {len(categories)} categories, {options['news']} news, "
+            f"{len(user_ids) - existing_users} users and {comment_count} comments."
+        ))
+
+    def words(self, count):
+        return ' '.join(self.random.choice(WORDS) for _ in range(count))
+
+    def create_images(self, count):
+        names = []
+        for i in range(count):
+            name = f'news/seed_{i}.jpg'
+            if not default_storage.exists(name):
+                color = tuple(self.random.randint(0, 255) for _ in range(3))
+                buffer = BytesIO()
+                Image.new('RGB', (1600, 900), color).save(buffer, 'JPEG', quality=90)
+                default_storage.save(name, ContentFile(buffer.getvalue()))
+            generate_image_variants(name, IMAGE_VARIANT_WIDTHS['app.News.news_image'])
+            names.append(name)
+        return names
+
+    def bulk_create(self, model, objects, **kwargs):
+        batch = []
+        for obj in objects:
+            batch.append(obj)
+            if len(batch) == self.batch_size:
+                model.objects.bulk_create(batch, **kwargs)
+                batch = []
+        if batch:
+            model.objects.bulk_create(batch, **kwargs)
@@ -0,0 +1,75 @@
+import json
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from app.querylog import fingerprint
+
+SORT_KEYS = {
+    'total': lambda group: group['total'],
+    'max': lambda group: group['durations'][-1],
+    'count': lambda group: len(group['durations']),
+    'mean': lambda group: group['total'] / len(group['durations']),
+}
+
+
+class Command(BaseCommand):
+    help = 'Summarize the slow-query log by query fingerprint, worst first.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', default=settings.SLOW_QUERY_LOG, help='Slow-query log file.')
+        parser.add_argument('--limit', type=int, default=10, help='Fingerprints to show.')
+        parser.add_argument('--sort', choices=SORT_KEYS, default='total')
+        parser.add_argument('--hours', type=float, help='Only entries from the last N hours.')
+        parser.add_argument('--plans', action='store_true', help='Print the latest EXPLAIN plan of each fingerprint.')
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(hours=options['hours']) if options['hours'] else None
+        groups = defaultdict(lambda: {
+            'total': 0.0, 'durations': [], 'views': Counter(), 'call_sites': Counter(), 'sql': None, 'plan': None,
+        })
+        try:
+            with open(options['log'], encoding='utf-8') as log:
+                for line in log:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if since is not None and parse_datetime(entry['time']) < since:
+                        continue
+                    group = groups[entry['fingerprint']]
+                    group['total'] += entry['duration']
+                    group['durations'].append(entry['duration'])
+                    group['views'][entry['view'] or '-'] += 1
+                    group['call_sites'][entry['call_site']] += 1
+                    group['sql'] = entry['sql']
+                    if entry.get('plan'):
+                        group['plan'] = entry['plan']
+        except FileNotFoundError:
+            raise CommandError(f"No slow-query log at {options['log']}.")
+
+        if not groups:
+            self.stdout.write('No slow queries logged.')
+            return
+        for group in groups.values():
+            group['durations'].sort()
+        worst = sorted(groups.items(), key=lambda item: SORT_KEYS[options['sort']](item[1]), reverse=True)
+        for key, group in worst[:options['limit']]:
+            durations = group['durations']
+            p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f"{key}  {len(durations)} times, total {group['total']:.2f} s, "
+                f"mean {group['total'] / len(durations) * 1000:.0f} ms, "
+                f"p95 {p95 * 1000:.0f} ms, max {durations[-1] * 1000:.0f} ms"
+            ))
+            for label, counter in (('view', group['views']), ('from', group['call_sites'])):
+                for value, count in counter.most_common(3):
+                    self.stdout.write(f'  {label}: {value} ({count})')
+            self.stdout.write(f"  {fingerprint(group['sql'])[:500]}")
+            if options['plans'] and group['plan']:
+                self.stdout.write('  ' + group['plan'].replace('\n', '\n  '))
+            self.stdout.write('')
@@ -0,0 +1,116 @@
+import mimetypes
+import re
+import stat
+from pathlib import Path
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_range(header, size):
+    """
+    Return the (start, stop) byte span of a single-range Range header, stop
+    exclusive. None means the header should be ignored (absent, malformed or
+    multi-range), False that it can't be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        length = int(last)
+        if length == 0 or size == 0:
+            return False
+        return max(size - length, 0), size
+    start = int(first)
+    if last and int(last) < start:
+        # An invalid byte-range-spec: the header is ignored (RFC 9110 14.2).
+        return None
+    if start >= size:
+        return False
+    return start, min(int(last) + 1, size) if last else size
+
+
+def if_range_matches(request, etag, last_modified):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == int(last_modified)
+
+
+def read_span(file, start, stop):
+    with file:
+        file.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_response(request, path, size, content_type, etag, last_modified):
+    span = None
+    if if_range_matches(request, etag, last_modified):
+        span = parse_range(request.META.get('HTTP_RANGE'), size)
+    if span is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+    if span is None:
+        # FileResponse lets the WSGI server use sendfile via wsgi.file_wrapper.
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    else:
+        start, stop = span
+        response = StreamingHttpResponse(
+            read_span(open(path, 'rb'), start, stop), status=206, content_type=content_type
+        )
+        response['Content-Length'] = stop - start
+        response['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    """
+    Serve a file from MEDIA_ROOT with ETag/Last-Modified validators and byte
+    ranges. With MEDIA_SERVE_MODE = 'x-accel' the body is left to nginx
+    through X-Accel-Redirect, so no app worker streams the bytes.
+    """
+    try:
+        fullpath = Path(safe_join(settings.MEDIA_ROOT, path))
+        file_stat = fullpath.stat()
+    except (SuspiciousFileOperation, OSError):
+        raise Http404('Файл не найден')
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise Http404('Файл не найден')
+
+    etag = f'"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"'
+    last_modified = int(file_stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
+        if settings.MEDIA_SERVE_MODE == 'x-accel':
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + quote(path)
+        else:
+            response = file_response(
+                request, fullpath, file_stat.st_size, content_type, etag, last_modified
+            )
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, public=True, max_age=settings.MEDIA_MAX_AGE)
+    return response
@@ -0,0 +1,505 @@
+import hmac
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+import redis
+from django.conf import settings
+from django.core.cache.backends.redis import RedisCache
+from django.db import connections
+from django.http import Http404, HttpResponse
+from django.template.base import Template
+from django.views.decorators.http import require_safe
+
+# Per-request timings and Prometheus metrics.
+#
+# MetricsMiddleware (app.middleware) puts a RequestStats in ``current_request``
+# for the duration of a request. Queries are counted by an execute wrapper
+# installed on every new database connection, template time by wrapping
+# Template.render and cache hits by MeteredRedisCache. Context variables are
+# copied into sync_to_async threads, so the async views are measured too.
+#
+# The aggregates are kept in the process. With METRICS_REDIS_URL set, a
+# background thread adds them to Redis every METRICS_FLUSH_INTERVAL seconds
+# (SharedStore), and /metrics on any worker reports the sum over all the
+# processes: counters and histograms in one hash per metric, the pool
+# gauges in a hash per process that expires when the process goes away.
+
+logger = logging.getLogger(__name__)
+
+current_request = ContextVar('current_request', default=None)
+
+PROCESSES_KEY = 'metrics:processes'
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+class RequestStats:
+    __slots__ = (
+        'request', 'start', 'queries', 'query_time', 'template_time', 'rendering', 'cache_hits', 'cache_misses', 'query_log',
+    )
+
+    def __init__(self, request=None):
+        self.request = request
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+        self.template_time = 0.0
+        self.rendering = False
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # A list of (sql, seconds) when the request is being profiled.
+        self.query_log = None
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self, total):
+        return ', '.join((
+            f'db;dur={self.query_time * 1000:.1f};desc="{self.queries} queries"',
+            f'tpl;dur={self.template_time * 1000:.1f}',
+            f'cache;desc="{self.cache_hits} hits, {self.cache_misses} misses"',
+            f'total;dur={total * 1000:.1f}',
+        ))
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(f'{name}="{_escape(value)}"' for name, value in pairs)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def drain(self):
+        """Take the values counted since the last drain, for SharedStore."""
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def restore(self, values):
+        for labels, value in values.items():
+            self.inc(*labels, amount=value)
+
+    def fields(self, values):
+        for labels, value in values.items():
+            yield json.dumps(labels), value
+
+    def load(self, fields):
+        return {tuple(json.loads(field)): _number(value) for field, value in fields.items()}
+
+    def samples(self, values=None):
+        if values is None:
+            with self.lock:
+                values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value}'
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (the last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(labels) or ([0] * (len(self.buckets) + 1), 0)
+            counts[index] += 1
+            self.values[labels] = [counts, total + value]
+
+    def drain(self):
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def restore(self, values):
+        with self.lock:
+            for labels, (counts, total) in values.items():
+                current, current_total = self.values.get(labels) or ([0] * (len(self.buckets) + 1), 0)
+                self.values[labels] = [[a + b for a, b in zip(current, counts)], current_total + total]
+
+    def fields(self, values):
+        for labels, (counts, total) in values.items():
+            for index, count in enumerate(counts):
+                if count:
+                    yield json.dumps([*labels, index]), count
+            yield json.dumps([*labels, 'sum']), total
+
+    def load(self, fields):
+        values = {}
+        for field, value in fields.items():
+            *labels, index = json.loads(field)
+            entry = values.setdefault(tuple(labels), [[0] * (len(self.buckets) + 1), 0])
+            if index == 'sum':
+                entry[1] = _number(value)
+            else:
+                entry[0][index] = _number(value)
+        return values
+
+    def samples(self, values=None):
+        if values is None:
+            with self.lock:
+                values = {labels: (list(counts), total) for labels, (counts, total) in self.values.items()}
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{_labels(self.labelnames, labels, [("le", bound)])} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {total}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}'
+
+
+class Collected:
+    """
+    A metric read at scrape time: collect() yields (labels, value) pairs.
+    SharedStore keeps a gauge per process and adds up the increases of a
+    counter.
+    """
+
+    def __init__(self, name, documentation, type, labelnames, collect):
+        self.name = name
+        self.documentation = documentation
+        self.type = type
+        self.labelnames = labelnames
+        self.collect = collect
+        # Counter values as of the last drain.
+        self.drained = {}
+
+    def drain(self):
+        values = dict(self.collect())
+        if self.type == 'gauge':
+            return values
+        increases = {}
+        for labels, value in values.items():
+            previous = self.drained.get(labels, 0)
+            # Less than before: the source was reset, e.g. a new pool.
+            increases[labels] = value - previous if value >= previous else value
+            self.drained[labels] = value
+        return increases
+
+    def restore(self, values):
+        if self.type != 'gauge':
+            for labels, value in values.items():
+                self.drained[labels] -= value
+
+    fields = Counter.fields
+    load = Counter.load
+
+    def samples(self, values=None):
+        if values is None:
+            values = dict(self.collect())
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self.labelnames, labels)} {value}'
+
+
+def _pool_stats():
+    """psycopg_pool statistics of each pooled database, see DB_POOL in the prod settings."""
+    for alias in connections:
+        pool = getattr(connections[alias], 'pool', None)
+        if pool is not None:
+            yield alias, pool.get_stats()
+
+
+def _pool_stat(key, scale=None):
+    def collect():
+        for alias, stats in _pool_stats():
+            value = stats.get(key, 0)
+            yield (alias,), value if scale is None else value / scale
+    return collect
+
+
+REQUESTS = Counter(
+    'news_http_requests_total', 'Requests by URL name, method and status code.', ('view', 'method', 'status'),
+)
+REQUEST_DURATION = Histogram(
+    'news_http_request_duration_seconds', 'Time spent handling a request.', ('view',),
+)
+DB_DURATION = Histogram(
+    'news_http_request_db_duration_seconds', 'Time spent in database queries per request.', ('view',),
+)
+DB_QUERIES = Histogram(
+    'news_http_request_db_queries', 'Database queries per request.', ('view',), buckets=QUERY_COUNT_BUCKETS,
+)
+TEMPLATE_DURATION = Histogram(
+    'news_http_request_template_duration_seconds', 'Time spent rendering templates per request.', ('view',),
+)
+CACHE_REQUESTS = Counter(
+    'news_http_cache_requests_total', 'Cache lookups made while handling requests.', ('view', 'result'),
+)
+
+DB_POOL_METRICS = [
+    Collected('news_db_pool_size', 'Connections in the pool.', 'gauge', ('database',), _pool_stat('pool_size')),
+    Collected(
+        'news_db_pool_max_size', 'Most connections the pool opens.', 'gauge', ('database',), _pool_stat('pool_max'),
+    ),
+    Collected(
+        'news_db_pool_available', 'Idle connections in the pool.', 'gauge', ('database',), _pool_stat('pool_available'),
+    ),
+    Collected(
+        'news_db_pool_requests_waiting', 'Threads waiting for a connection right now.', 'gauge', ('database',),
+        _pool_stat('requests_waiting'),
+    ),
+    Collected(
+        'news_db_pool_requests_total', 'Connections handed out by the pool.', 'counter', ('database',),
+        _pool_stat('requests_num'),
+    ),
+    Collected(
+        'news_db_pool_requests_queued_total', 'Connection requests that had to wait, the pool being exhausted.',
+        'counter', ('database',), _pool_stat('requests_queued'),
+    ),
+    Collected(
+        'news_db_pool_wait_seconds_total', 'Time spent waiting for a connection.', 'counter', ('database',),
+        _pool_stat('requests_wait_ms', 1000),
+    ),
+    Collected(
+        'news_db_pool_timeouts_total', 'Connection requests that timed out or failed.', 'counter', ('database',),
+        _pool_stat('requests_errors'),
+    ),
+]
+
+REGISTRY = [REQUESTS, REQUEST_DURATION, DB_DURATION, DB_QUERIES, TEMPLATE_DURATION, CACHE_REQUESTS, *DB_POOL_METRICS]
+
+
+class SharedStore:
+    """The metrics of every process, added up in Redis (see the notes at the top)."""
+
+    def __init__(self, url, interval):
+        self.url = url
+        self.interval = interval
+        self.client = redis.Redis.from_url(url)
+        self.lock = threading.Lock()
+        self.pid = None
+        self.process = None
+
+    def start(self):
+        """Start flushing this process's metrics, once per process."""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.process = f'{socket.gethostname()}:{self.pid}'
+                threading.Thread(target=self.run, name='metrics-flush', daemon=True).start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except redis.RedisError:
+                logger.warning('Could not flush the metrics to Redis', exc_info=True)
+
+    def flush(self, registry=None):
+        registry = REGISTRY if registry is None else registry
+        self.start()
+        with self.lock:
+            drained = [(metric, metric.drain()) for metric in registry]
+            process_key = f'metrics:process:{self.process}'
+            gauges = {}
+            try:
+                with self.client.pipeline() as pipeline:
+                    for metric, values in drained:
+                        for field, value in metric.fields(values):
+                            if metric.type == 'gauge':
+                                gauges[f'{metric.name} {field}'] = value
+                            else:
+                                pipeline.hincrbyfloat(f'metrics:{metric.name}', field, value)
+                    pipeline.delete(process_key)
+                    if gauges:
+                        pipeline.hset(process_key, mapping=gauges)
+                        pipeline.expire(process_key, self.interval * 3)
+                        pipeline.sadd(PROCESSES_KEY, self.process)
+                    pipeline.execute()
+            except redis.RedisError:
+                for metric, values in drained:
+                    metric.restore(values)
+                raise
+
+    def load(self, registry=None):
+        """Values of every metric, added up over the processes, by metric name."""
+        registry = REGISTRY if registry is None else registry
+        processes = [process.decode() for process in self.client.smembers(PROCESSES_KEY)]
+        with self.client.pipeline(transaction=False) as pipeline:
+            for metric in registry:
+                pipeline.hgetall(f'metrics:{metric.name}')
+            for process in processes:
+                pipeline.hgetall(f'metrics:process:{process}')
+            results = pipeline.execute()
+        fields = {metric.name: {} for metric in registry}
+        for metric, values in zip(registry, results):
+            if metric.type != 'gauge':
+                fields[metric.name] = {field.decode(): value for field, value in values.items()}
+        gone = []
+        for process, values in zip(processes, results[len(registry):]):
+            if not values:
+                gone.append(process)
+            for key, value in values.items():
+                name, field = key.decode().split(' ', 1)
+                if name in fields:
+                    fields[name][field] = fields[name].get(field, 0) + float(value)
+        if gone:
+            self.client.srem(PROCESSES_KEY, *gone)
+        return {metric.name: metric.load(fields[metric.name]) for metric in registry}
+
+
+_store = None
+
+
+def get_store():
+    """The SharedStore, None while METRICS_REDIS_URL is empty."""
+    global _store
+    if not settings.METRICS_REDIS_URL:
+        return None
+    if _store is None or _store.url != settings.METRICS_REDIS_URL:
+        _store = SharedStore(settings.METRICS_REDIS_URL, settings.METRICS_FLUSH_INTERVAL)
+    return _store
+
+
+def observe_request(view, method, status, stats, total):
+    store = get_store()
+    if store is not None:
+        store.start()
+    REQUESTS.inc(view, method, status)
+    REQUEST_DURATION.observe(total, view)
+    DB_DURATION.observe(stats.query_time, view)
+    DB_QUERIES.observe(stats.queries, view)
+    TEMPLATE_DURATION.observe(stats.template_time, view)
+    if stats.cache_hits:
+        CACHE_REQUESTS.inc(view, 'hit', amount=stats.cache_hits)
+    if stats.cache_misses:
+        CACHE_REQUESTS.inc(view, 'miss', amount=stats.cache_misses)
+
+
+def render_metrics(registry=REGISTRY, values=None):
+    """The exposition of ``values`` (from SharedStore.load), or of this process's metrics."""
+    lines = []
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.samples(None if values is None else values[metric.name]))
+    return '\n'.join(lines) + '\n'
+
+
+@require_safe
+def metrics_view(request):
+    """
+    Prometheus exposition of the metrics of every process, or of this one
+    without METRICS_REDIS_URL. Outside DEBUG it needs
+    ``Authorization: Bearer <METRICS_TOKEN>`` and is hidden while no token is
+    configured.
+    """
+    if not settings.DEBUG:
+        token = settings.METRICS_TOKEN
+        given = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not token or not hmac.compare_digest(given, token):
+            raise Http404
+    store = get_store()
+    values = None
+    if store is not None:
+        store.flush()
+        values = store.load()
+    return HttpResponse(render_metrics(values=values), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def record_query(execute, sql, params, many, context):
+    stats = current_request.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        stats.queries += 1
+        stats.query_time += duration
+        if stats.query_log is not None:
+            stats.query_log.append((sql, duration))
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """connection_created receiver."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def instrument_templates():
+    """Wrap Template.render to time the outermost render of each template."""
+    render = Template.render
+    if getattr(render, 'metered', False):
+        return
+
+    def metered_render(self, context):
+        stats = current_request.get()
+        if stats is None or stats.rendering:
+            return render(self, context)
+        stats.rendering = True
+        start = time.perf_counter()
+        try:
+            return render(self, context)
+        finally:
+            stats.template_time += time.perf_counter() - start
+            stats.rendering = False
+
+    metered_render.metered = True
+    Template.render = metered_render
+
+
+class MeteredRedisCache(RedisCache):
+    """RedisCache counting the hits and misses of the current request."""
+
+    _missing = object()
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, self._missing, version)
+        stats = current_request.get()
+        if stats is not None:
+            if value is self._missing:
+                stats.cache_misses += 1
+            else:
+                stats.cache_hits += 1
+        return default if value is self._missing else value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        values = super().get_many(keys, version)
+        stats = current_request.get()
+        if stats is not None:
+            stats.cache_hits += len(values)
+            stats.cache_misses += len(keys) - len(values)
+        return values
@@ -0,0 +1,151 @@
+import random
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .metrics import RequestStats, current_request, observe_request
+from .profiling import CPROFILE, RequestProfiler, save_profile
+from .routers import Routing, current_routing
+
+
+class MetricsMiddleware:
+    """
+    Time every request, count its queries and cache lookups, send the
+    breakdown in a Server-Timing header and add it to the /metrics
+    histograms under the URL name. Put it first in MIDDLEWARE so the other
+    middleware is included in the total.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = RequestStats(request)
+        token = current_request.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.finish(request, response, stats)
+
+    async def __acall__(self, request):
+        stats = RequestStats(request)
+        token = current_request.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.finish(request, response, stats)
+
+    def finish(self, request, response, stats):
+        total = stats.elapsed()
+        match = request.resolver_match
+        view = match.view_name if match else '<unmatched>'
+        observe_request(view, request.method, response.status_code, stats, total)
+        response.headers['Server-Timing'] = stats.server_timing(total)
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Profile a PROFILING_SAMPLE_RATE fraction of requests with cProfile, and
+    keep stack samples of any request slower than PROFILING_SLOW_THRESHOLD,
+    storing them with the URL and query log (see app.profiling). Goes right
+    after MetricsMiddleware, whose execute wrapper collects the queries.
+
+    Only the WSGI handler is profiled: under ASGI concurrent requests share
+    the event loop and executor threads, so the middleware drops out.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        if iscoroutinefunction(get_response):
+            raise MiddlewareNotUsed('Request profiling covers the WSGI handler only.')
+        self.get_response = get_response
+
+    def should_save(self, profiler, duration):
+        return profiler.kind == CPROFILE or duration >= settings.PROFILING_SLOW_THRESHOLD
+
+    def __call__(self, request):
+        stats = current_request.get()
+        token = None
+        if stats is None:
+            stats = RequestStats(request)
+            token = current_request.set(stats)
+        stats.query_log = []
+        profiler = RequestProfiler(random.random() < settings.PROFILING_SAMPLE_RATE)
+        profiler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.stop()
+            if token is not None:
+                current_request.reset(token)
+        duration = stats.elapsed()
+        if self.should_save(profiler, duration):
+            save_profile(request, response, profiler, duration, stats.query_log)
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Send the reads of GET and HEAD requests to one of DATABASE_REPLICAS (see
+    app.routers), unless the client wrote within the last
+    DATABASE_REPLICA_STICKY_SECONDS. Goes before SessionMiddleware so that
+    sessions are read from the same database as the rest.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def start(self, request):
+        pinned = request.method not in ('GET', 'HEAD') or settings.DATABASE_REPLICA_PIN_COOKIE in request.COOKIES
+        routing = Routing(None if pinned else random.choice(settings.DATABASE_REPLICAS))
+        return routing, current_routing.set(routing)
+
+    def finish(self, response, routing):
+        if routing.wrote:
+            response.set_cookie(
+                settings.DATABASE_REPLICA_PIN_COOKIE, '1',
+                max_age=settings.DATABASE_REPLICA_STICKY_SECONDS, httponly=True, samesite='Lax',
+            )
+        return response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        routing, token = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        return self.finish(response, routing)
+
+    async def __acall__(self, request):
+        routing, token = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_routing.reset(token)
+        return self.finish(response, routing)
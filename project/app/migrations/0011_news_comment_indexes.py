@@ -0,0 +1,39 @@
+# Generated by Django 5.1 on 2026-10-18 17:30
+# CREATE INDEX CONCURRENTLY can't run in a transaction, hence atomic = False.
+
+import django.core.validators
+from django.db import migrations, models
+
+import app.operations
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('app', '0010_alter_comment_author_alter_comment_comment_posted_at_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='age',
+            field=models.PositiveIntegerField(default=18, validators=[django.core.validators.MinValueValidator(18), django.core.validators.MaxValueValidator(120)], verbose_name='Возраст'),
+        ),
+        app.operations.AddIndexConcurrently(
+            model_name='comment',
+            index=models.Index(fields=['comment_to_news', '-comment_posted_at', '-id'], include=('author',), name='app_comment_news_posted_idx'),
+        ),
+        app.operations.AddIndexConcurrently(
+            model_name='comment',
+            index=models.Index(fields=['author', '-comment_posted_at'], name='app_comment_author_posted_idx'),
+        ),
+        app.operations.AddIndexConcurrently(
+            model_name='news',
+            index=models.Index(fields=['-news_posted_at', '-id'], name='app_news_posted_idx'),
+        ),
+        app.operations.AddIndexConcurrently(
+            model_name='news',
+            index=models.Index(fields=['category', '-news_posted_at', '-id'], name='app_news_category_posted_idx'),
+        ),
+    ]
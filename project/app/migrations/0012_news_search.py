@@ -0,0 +1,85 @@
+# Full-text search index for News (see app/search.py).
+#
+# PostgreSQL: a trigger-maintained tsvector column, backfilled in batches and
+# indexed with CREATE INDEX CONCURRENTLY so app_news stays writable. Adding
+# the nullable column without a default doesn't rewrite the table.
+# SQLite: an external-content FTS5 table kept in sync by triggers.
+
+from django.db import migrations
+
+from app.search import install_sqlite_search, uninstall_sqlite_search
+
+BACKFILL_BATCH_SIZE = 1000
+
+POSTGRES_VECTOR = (
+    "setweight(to_tsvector('russian'::regconfig, coalesce({row}title, '')), 'A') || "
+    "setweight(to_tsvector('russian'::regconfig, coalesce({row}news_text, '')), 'B')"
+)
+
+POSTGRES_FORWARDS = [
+    "ALTER TABLE app_news ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    """
+    CREATE OR REPLACE FUNCTION app_news_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := %s;
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """ % POSTGRES_VECTOR.format(row='NEW.'),
+    """
+    CREATE TRIGGER app_news_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, news_text ON app_news
+    FOR EACH ROW EXECUTE FUNCTION app_news_search_vector_update()
+    """,
+]
+
+POSTGRES_BACKWARDS = [
+    "DROP INDEX CONCURRENTLY IF EXISTS app_news_search_idx",
+    "DROP TRIGGER IF EXISTS app_news_search_vector_trigger ON app_news",
+    "DROP FUNCTION IF EXISTS app_news_search_vector_update()",
+    "ALTER TABLE app_news DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        install_sqlite_search(connection)
+        return
+    if connection.vendor != 'postgresql':
+        return
+    for sql in POSTGRES_FORWARDS:
+        schema_editor.execute(sql)
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT coalesce(max(id), 0) FROM app_news")
+        max_id = cursor.fetchone()[0]
+        for start in range(0, max_id, BACKFILL_BATCH_SIZE):
+            cursor.execute(
+                "UPDATE app_news SET search_vector = %s WHERE id > %%s AND id <= %%s"
+                % POSTGRES_VECTOR.format(row=''),
+                [start, start + BACKFILL_BATCH_SIZE],
+            )
+    schema_editor.execute(
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS app_news_search_idx ON app_news USING gin (search_vector)"
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        uninstall_sqlite_search(connection)
+    elif connection.vendor == 'postgresql':
+        for sql in POSTGRES_BACKWARDS:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('app', '0011_news_comment_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
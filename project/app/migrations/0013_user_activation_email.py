@@ -0,0 +1,32 @@
+# Generated by Django 5.1 on 2026-10-18 17:38
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_existing_users_sent(apps, schema_editor):
+    # Everyone registered so far already got their email from the old
+    # per-registration task; don't let the batch flush send it again.
+    User = apps.get_model('app', 'User')
+    User.objects.filter(activation_email_sent_at__isnull=True).update(activation_email_sent_at=F('date_joined'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_news_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='activation_email_attempts',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Неудачных отправок письма активации'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='activation_email_sent_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Письмо активации отправлено'),
+        ),
+        migrations.RunPython(mark_existing_users_sent, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1 on 2026-10-18 17:50
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 1000
+
+
+def count_comments(apps, schema_editor):
+    # Batches of news keep each UPDATE, and the row locks it takes, short.
+    News = apps.get_model('app', 'News')
+    Comment = apps.get_model('app', 'Comment')
+    actual = Coalesce(Subquery(
+        Comment.objects.filter(comment_to_news=OuterRef('pk')).order_by()
+        .values('comment_to_news').annotate(count=Count('pk')).values('count')
+    ), 0)
+    last_pk = 0
+    while True:
+        pks = list(News.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:BATCH_SIZE])
+        if not pks:
+            break
+        News.objects.filter(pk__in=pks).update(comments_count=actual)
+        last_pk = pks[-1]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('app', '0013_user_activation_email'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='news',
+            name='comments_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Комментариев'),
+        ),
+        migrations.RunPython(count_comments, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_news_excerpt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='news',
+            name='unique_views',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Уникальных просмотров'),
+        ),
+        migrations.AddField(
+            model_name='news',
+            name='views_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Просмотров'),
+        ),
+    ]
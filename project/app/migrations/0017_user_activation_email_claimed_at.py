@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-18 18:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_news_views_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='activation_email_claimed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Письмо активации отправляется с'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.1 on 2026-10-18 18:40
+
+from django.contrib.auth import BACKEND_SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import migrations
+from django.utils import timezone
+
+BATCH_SIZE = 1000
+OLD_BACKEND = 'django.contrib.auth.backends.ModelBackend'
+NEW_BACKEND = 'app.backends.CachedModelBackend'
+
+
+def move_sessions(apps, old, new):
+    # get_user() logs out a session whose backend is no longer in
+    # AUTHENTICATION_BACKENDS, so point the live ones at the new backend.
+    Session = apps.get_model('sessions', 'Session')
+    store = SessionStore()
+    last_key = ''
+    while True:
+        sessions = list(
+            Session.objects.filter(session_key__gt=last_key, expire_date__gt=timezone.now())
+            .order_by('session_key')[:BATCH_SIZE]
+        )
+        if not sessions:
+            break
+        last_key = sessions[-1].session_key
+        moved = []
+        for session in sessions:
+            data = store.decode(session.session_data)
+            if data.get(BACKEND_SESSION_KEY) == old:
+                data[BACKEND_SESSION_KEY] = new
+                session.session_data = store.encode(data)
+                moved.append(session)
+        Session.objects.bulk_update(moved, ['session_data'])
+
+
+def forwards(apps, schema_editor):
+    move_sessions(apps, OLD_BACKEND, NEW_BACKEND)
+
+
+def backwards(apps, schema_editor):
+    move_sessions(apps, NEW_BACKEND, OLD_BACKEND)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('app', '0017_user_activation_email_claimed_at'),
+        ('sessions', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
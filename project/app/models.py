@@ -2,6 +2,7 @@ from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin, BaseUserManager, UserManager
 from django.contrib.auth.hashers import make_password
 from django.utils import timezone
+from django.utils.text import Truncator
 from django.utils.translation import gettext_lazy as _
 from django.core.validators import MinValueValidator, MaxValueValidator
 
@@ -67,6 +68,10 @@ class User(AbstractBaseUser, PermissionsMixin):
         ),
     )
     date_joined = models.DateTimeField(_("date joined"), default=timezone.now)
+    activation_email_sent_at = models.DateTimeField("Письмо активации отправлено", null=True, blank=True, editable=False)
+    activation_email_attempts = models.PositiveSmallIntegerField("Неудачных отправок письма активации", default=0, editable=False)
+    # Set while a flush_activation_emails batch is sending to the user.
+    activation_email_claimed_at = models.DateTimeField("Письмо активации отправляется с", null=True, blank=True, editable=False)
 
     objects = UserManager()
 
@@ -75,6 +80,14 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     def __str__(self) -> str:
         return self.email
+
+    def get_session_auth_hash(self):
+        # Users from app.backends.CachedModelBackend come without their
+        # password but with its hash, unless the password was set since.
+        cached = getattr(self, 'cached_session_auth_hash', None)
+        if cached is not None and 'password' in self.get_deferred_fields():
+            return cached
+        return super().get_session_auth_hash()
     
     class Meta:
         verbose_name = "Пользователь"
@@ -90,20 +103,47 @@ class Category(models.Model):
         verbose_name = "Категория"
         verbose_name_plural = "Категории"
 
+EXCERPT_WORDS = 10
+EXCERPT_MAX_LENGTH = 300
+
+
+def news_excerpt(text):
+    """The start of a news text shown on the index cards."""
+    return Truncator(Truncator(text).words(EXCERPT_WORDS, truncate=' …')).chars(EXCERPT_MAX_LENGTH)
+
+
 class News(models.Model):
     title = models.CharField("Заголовок", max_length=100)
     news_text = models.TextField("Содержание")
+    # Saved alongside news_text so the index never has to read the full text.
+    excerpt = models.CharField("Анонс", max_length=EXCERPT_MAX_LENGTH, blank=True, editable=False)
     news_image = models.ImageField("Фото статьи", upload_to='news', blank=False)
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True)
     news_posted_at = models.DateTimeField("Дата публикации", default=timezone.now)
+    # Kept in step by the Comment signals, repaired by reconcile_comment_counts.
+    comments_count = models.PositiveIntegerField("Комментариев", default=0, editable=False)
+    # Buffered in Redis and added up by flush_view_counts (see app.popularity).
+    views_count = models.PositiveIntegerField("Просмотров", default=0, editable=False)
+    unique_views = models.PositiveIntegerField("Уникальных просмотров", default=0, editable=False)
 
     def __str__(self) -> str:
         return self.title
+
+    def save(self, *args, update_fields=None, **kwargs):
+        if update_fields is None or 'news_text' in update_fields:
+            self.excerpt = news_excerpt(self.news_text)
+            if update_fields is not None:
+                update_fields = {*update_fields, 'excerpt'}
+        super().save(*args, update_fields=update_fields, **kwargs)
     
     class Meta:
         verbose_name = "Публикация"
         verbose_name_plural = "Новости"
         ordering = ["-news_posted_at"]
+        indexes = [
+            models.Index(fields=["-news_posted_at", "-id"], name="app_news_posted_idx"),
+            models.Index(fields=["category", "-news_posted_at", "-id"], name="app_news_category_posted_idx"),
+        ]
 
 class Comment(models.Model):
     author = models.ForeignKey(User, verbose_name="Автор", on_delete=models.CASCADE)
@@ -118,6 +158,14 @@ class Comment(models.Model):
         verbose_name = "Комментарий"
         verbose_name_plural = "Комментарии"
         ordering = ["-comment_posted_at"]
+        indexes = [
+            models.Index(
+                fields=["comment_to_news", "-comment_posted_at", "-id"],
+                include=["author"],
+                name="app_comment_news_posted_idx",
+            ),
+            models.Index(fields=["author", "-comment_posted_at"], name="app_comment_author_posted_idx"),
+        ]
 
 
 # Create your models here.
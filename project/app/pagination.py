@@ -0,0 +1,97 @@
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_bytes, force_str
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class CursorPage:
+    def __init__(self, object_list, next_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    Paginate a queryset by the (datetime field, pk) pair, newest first.
+
+    Every page is fetched with ``WHERE (field, id) < (cursor) ORDER BY field
+    DESC, id DESC LIMIT n``, so page N costs the same as page 1 instead of
+    scanning the OFFSET rows before it.
+    """
+
+    def __init__(self, queryset, per_page, field):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.field = field
+
+    def encode_cursor(self, obj):
+        value = getattr(obj, self.field)
+        return urlsafe_base64_encode(force_bytes(f'{value.isoformat()}|{obj.pk}'))
+
+    def decode_cursor(self, cursor):
+        try:
+            value, pk = force_str(urlsafe_base64_decode(cursor)).split('|')
+            value, pk = parse_datetime(value), int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise InvalidCursor(cursor)
+        if value is None:
+            raise InvalidCursor(cursor)
+        return value, pk
+
+    def is_valid_cursor(self, cursor):
+        try:
+            self.decode_cursor(cursor)
+        except InvalidCursor:
+            return False
+        return True
+
+    def _queryset(self, cursor):
+        queryset = self.queryset.order_by(f'-{self.field}', '-pk')
+        if cursor:
+            value, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(**{f'{self.field}__lt': value}) | Q(**{self.field: value, 'pk__lt': pk})
+            )
+        return queryset[:self.per_page + 1]
+
+    def _page(self, object_list):
+        next_cursor = None
+        if len(object_list) > self.per_page:
+            object_list = object_list[:self.per_page]
+            next_cursor = self.encode_cursor(object_list[-1])
+        return CursorPage(object_list, next_cursor)
+
+    def page(self, cursor=None):
+        return self._page(list(self._queryset(cursor)))
+
+    async def apage(self, cursor=None):
+        return self._page([obj async for obj in self._queryset(cursor)])
+
+    def get_page(self, cursor=None):
+        """
+        Return the page for the cursor, falling back to the first page when
+        the cursor is malformed.
+        """
+        try:
+            return self.page(cursor)
+        except InvalidCursor:
+            return self.page()
+
+    async def aget_page(self, cursor=None):
+        try:
+            return await self.apage(cursor)
+        except InvalidCursor:
+            return await self.apage()
@@ -0,0 +1,198 @@
+import hashlib
+import logging
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import News
+
+# Article view counts.
+#
+# Every news page view runs record_view(), one Lua script against the
+# VIEW_COUNT_REDIS_URL database. The script adds the view to a pending hash
+# and the reader to the article's HyperLogLog for the day. A reader new to
+# that HyperLogLog also counts as a unique view and scores a point in the
+# day's ranking, a sorted set. flush_view_counts (app.task, run by
+# celery-beat) adds the pending hash to News.views_count and
+# News.unique_views, so the database sees one UPDATE per flush instead of
+# one per view. The "most read" block on the index ranks the articles with
+# the most unique readers today and over the last week; it is rebuilt at
+# most every MOST_READ_TIMEOUT seconds.
+
+logger = logging.getLogger(__name__)
+
+PENDING_KEY = 'views:pending'
+# The pending hash being flushed. It is renamed away first, so views keep
+# being counted meanwhile; one left behind by a failed flush goes first.
+FLUSHING_KEY = 'views:flushing'
+FLUSH_LOCK_KEY = 'views:flush-lock'
+WEEK_RANK_KEY = 'views:rank:week'
+MOST_READ_KEY = 'most_read'
+# (digest, version) of the last block built.
+MOST_READ_VERSION_KEY = 'most_read:version'
+
+RECORD_VIEW_SCRIPT = """
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+if redis.call('PFADD', KEYS[2], ARGV[2]) == 1 then
+    redis.call('HINCRBY', KEYS[1], ARGV[1] .. ':u', 1)
+    redis.call('ZINCRBY', KEYS[3], 1, ARGV[1])
+    redis.call('EXPIRE', KEYS[3], ARGV[3])
+end
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+"""
+
+_client = None
+_record_view_script = None
+
+
+def get_client():
+    """Redis client of the view counters, None while VIEW_COUNTING is off."""
+    global _client, _record_view_script
+    if not settings.VIEW_COUNTING:
+        return None
+    if _client is None:
+        _client = redis.Redis.from_url(settings.VIEW_COUNT_REDIS_URL)
+        _record_view_script = _client.register_script(RECORD_VIEW_SCRIPT)
+    return _client
+
+
+def _day(date):
+    return f'{date:%Y%m%d}'
+
+
+def _readers_key(news_id, date):
+    return f'views:readers:{news_id}:{_day(date)}'
+
+
+def _rank_key(date):
+    return f'views:rank:{_day(date)}'
+
+
+def visitor_id(request):
+    """The reader in the HyperLogLogs: the user, or a hash of the address and browser."""
+    if request.user.is_authenticated:
+        return f'u{request.user.pk}'
+    ident = f"{request.META.get('REMOTE_ADDR', '')}|{request.headers.get('User-Agent', '')}"
+    return 'a' + hashlib.blake2b(ident.encode(), digest_size=8).hexdigest()
+
+
+def record_view(request, news_id):
+    client = get_client()
+    if client is None:
+        return
+    today = timezone.localdate()
+    try:
+        _record_view_script(
+            keys=[PENDING_KEY, _readers_key(news_id, today), _rank_key(today)],
+            args=[news_id, visitor_id(request), settings.VIEW_COUNT_RETENTION_DAYS * 24 * 60 * 60],
+        )
+    except redis.RedisError as e:
+        # A lost view is better than a failed page.
+        logger.warning('Could not count a view of news %s: %s', news_id, e)
+
+
+@contextmanager
+def pending_views():
+    """
+    Take the views counted since the last flush, as {news_id: (views,
+    unique views)}. They are dropped from Redis when the block exits
+    without an error, so a failed flush is retried with them; one that
+    fails after committing counts them twice.
+    """
+    client = get_client()
+    if client is None:
+        yield {}
+        return
+    lock = client.lock(FLUSH_LOCK_KEY, timeout=settings.VIEW_COUNT_FLUSH_INTERVAL * 10)
+    if not lock.acquire(blocking=False):
+        yield {}
+        return
+    try:
+        if not client.exists(FLUSHING_KEY) and client.exists(PENDING_KEY):
+            client.rename(PENDING_KEY, FLUSHING_KEY)
+        counts = {}
+        for field, count in client.hgetall(FLUSHING_KEY).items():
+            news_id, _, unique = field.decode().partition(':')
+            views, uniques = counts.get(int(news_id), (0, 0))
+            counts[int(news_id)] = (views, uniques + int(count)) if unique else (views + int(count), uniques)
+        yield counts
+        client.delete(FLUSHING_KEY)
+    finally:
+        lock.release()
+
+
+def _parse_ranking(ranking):
+    return [(int(news_id), int(readers)) for news_id, readers in ranking]
+
+
+def _with_version(most_read):
+    """
+    Give the block the version of the last one built when it shows the same
+    news, so that the index keeps its ETag, and its 304s, across rebuilds
+    while the ranking stands still.
+    """
+    shown = [[(item['pk'], item['title']) for item in most_read[period]] for period in ('today', 'week')]
+    digest = hashlib.blake2b(repr(shown).encode(), digest_size=8).hexdigest()
+    previous = cache.get(MOST_READ_VERSION_KEY)
+    if previous is not None and previous[0] == digest:
+        most_read['version'] = previous[1]
+    else:
+        most_read['version'] = time.time_ns()
+        cache.set(MOST_READ_VERSION_KEY, (digest, most_read['version']), None)
+    return most_read
+
+
+def build_most_read():
+    client = get_client()
+    most_read = {'today': [], 'week': []}
+    if client is None:
+        return _with_version(most_read)
+    today = timezone.localdate()
+    size = settings.MOST_READ_SIZE
+    try:
+        with client.pipeline() as pipe:
+            pipe.zrevrange(_rank_key(today), 0, size - 1, withscores=True)
+            pipe.zunionstore(WEEK_RANK_KEY, [_rank_key(today - timedelta(days=days)) for days in range(7)])
+            pipe.zrevrange(WEEK_RANK_KEY, 0, size - 1, withscores=True)
+            pipe.expire(WEEK_RANK_KEY, settings.MOST_READ_TIMEOUT)
+            today_ranking, _, week_ranking, _ = pipe.execute()
+    except redis.RedisError as e:
+        logger.warning('Could not read the most read news: %s', e)
+        return _with_version(most_read)
+    rankings = {'today': _parse_ranking(today_ranking), 'week': _parse_ranking(week_ranking)}
+    titles = dict(
+        News.objects.filter(pk__in={news_id for ranking in rankings.values() for news_id, _ in ranking})
+        .values_list('pk', 'title')
+    )
+    for period, ranking in rankings.items():
+        most_read[period] = [
+            {'pk': news_id, 'title': titles[news_id], 'readers': readers}
+            for news_id, readers in ranking if news_id in titles
+        ]
+    return _with_version(most_read)
+
+
+def get_most_read():
+    """
+    The most read news today and this week, {'today': [...], 'week': [...]},
+    with a 'version' (time_ns) that changes when the news shown do.
+    """
+    most_read = cache.get(MOST_READ_KEY)
+    if most_read is None:
+        most_read = build_most_read()
+        cache.set(MOST_READ_KEY, most_read, settings.MOST_READ_TIMEOUT)
+    return most_read
+
+
+async def aget_most_read():
+    most_read = await cache.aget(MOST_READ_KEY)
+    if most_read is None:
+        most_read = await sync_to_async(build_most_read)()
+        await cache.aset(MOST_READ_KEY, most_read, settings.MOST_READ_TIMEOUT)
+    return most_read
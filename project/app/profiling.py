@@ -0,0 +1,202 @@
+import cProfile
+import io
+import marshal
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+# Request profiles for ProfilingMiddleware (app.middleware).
+#
+# Two profilers feed it. A PROFILING_SAMPLE_RATE fraction of requests runs
+# under cProfile. Every other request has its thread's stack sampled every
+# PROFILING_SAMPLE_INTERVAL seconds by one background thread, which is cheap
+# enough for all traffic, and the samples are kept when the request turns
+# out slower than PROFILING_SLOW_THRESHOLD.
+#
+# Only requests served by the WSGI handler are profiled. Under ASGI the
+# requests interleave on the event loop thread and their sync parts on the
+# executor threads, so neither profiler could tell one request's work from
+# another's; ProfilingMiddleware is left out of the async chain.
+#
+# Profiles are stored in the default cache with an index of the newest
+# PROFILING_KEEP ids, to be browsed from the staff pages in app.views.
+
+PROFILE_INDEX_KEY = 'profiles:index'
+CPROFILE = 'cprofile'
+SAMPLED = 'sampled'
+
+# cProfile can only be enabled by one request at a time.
+_cprofile_lock = threading.Lock()
+
+
+def _profile_key(profile_id):
+    return f'profiles:{profile_id}'
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({code.co_filename}:{frame.f_lineno})'
+
+
+class StackSampler:
+    """
+    Collapsed stacks of the watched threads, sampled at a fixed interval.
+    Each watch() gets its own samples, even when a thread is watched twice.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.watched = defaultdict(list)
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def watch(self, thread_id):
+        samples = Counter()
+        with self.lock:
+            self.watched[thread_id].append(samples)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='stack-sampler', daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+        return samples
+
+    def unwatch(self, thread_id, samples):
+        with self.lock:
+            watchers = self.watched.get(thread_id, [])
+            watchers[:] = [watcher for watcher in watchers if watcher is not samples]
+            if not watchers:
+                self.watched.pop(thread_id, None)
+
+    def run(self):
+        while True:
+            # Sampling under the lock means a thread's samples are final
+            # once unwatch() returns.
+            with self.lock:
+                if not self.watched:
+                    self.wakeup.clear()
+                else:
+                    frames = sys._current_frames()
+                    for thread_id, watchers in self.watched.items():
+                        frame = frames.get(thread_id)
+                        stack = []
+                        while frame is not None:
+                            stack.append(_frame_name(frame))
+                            frame = frame.f_back
+                        if stack:
+                            stack = ';'.join(reversed(stack))
+                            for samples in watchers:
+                                samples[stack] += 1
+                    del frames
+            if not self.wakeup.is_set():
+                self.wakeup.wait()
+            else:
+                time.sleep(self.interval)
+
+
+_sampler = None
+
+
+def get_sampler():
+    global _sampler
+    if _sampler is None:
+        _sampler = StackSampler(settings.PROFILING_SAMPLE_INTERVAL)
+    return _sampler
+
+
+class RequestProfiler:
+    """Profile one request with cProfile when it has been sampled, else with the stack sampler."""
+
+    def __init__(self, use_cprofile):
+        self.cprofile = None
+        self.samples = None
+        self.thread_id = threading.get_ident()
+        if use_cprofile and _cprofile_lock.acquire(blocking=False):
+            self.cprofile = cProfile.Profile()
+
+    def start(self):
+        if self.cprofile is not None:
+            self.cprofile.enable()
+        else:
+            self.samples = get_sampler().watch(self.thread_id)
+
+    def stop(self):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            _cprofile_lock.release()
+        else:
+            get_sampler().unwatch(self.thread_id, self.samples)
+
+    @property
+    def kind(self):
+        return CPROFILE if self.cprofile is not None else SAMPLED
+
+    def dump(self):
+        """The profile as a .prof file for cProfile, or collapsed stacks (flamegraph.pl, speedscope)."""
+        if self.cprofile is not None:
+            return marshal.dumps(pstats.Stats(self.cprofile).stats)
+        return '\n'.join(f'{stack} {count}' for stack, count in self.samples.most_common()).encode()
+
+
+def save_profile(request, response, profiler, duration, query_log):
+    profile_id = uuid.uuid4().hex
+    match = request.resolver_match
+    profile = {
+        'id': profile_id,
+        'kind': profiler.kind,
+        'created_at': timezone.now(),
+        'method': request.method,
+        'url': request.get_full_path(),
+        'view': match.view_name if match else '',
+        'status': response.status_code,
+        'duration': duration,
+        'queries': query_log or [],
+        'data': profiler.dump(),
+    }
+    cache.set(_profile_key(profile_id), profile, settings.PROFILING_TIMEOUT)
+    index = [profile_id, *(cache.get(PROFILE_INDEX_KEY) or [])][:settings.PROFILING_KEEP]
+    cache.set(PROFILE_INDEX_KEY, index, settings.PROFILING_TIMEOUT)
+    return profile_id
+
+
+def get_profile(profile_id):
+    return cache.get(_profile_key(profile_id))
+
+
+def list_profiles():
+    """Stored profiles, newest first, without their data."""
+    ids = cache.get(PROFILE_INDEX_KEY) or []
+    profiles = cache.get_many([_profile_key(profile_id) for profile_id in ids])
+    return [
+        {key: value for key, value in profiles[_profile_key(profile_id)].items() if key != 'data'}
+        for profile_id in ids if _profile_key(profile_id) in profiles
+    ]
+
+
+def profile_filename(profile):
+    extension = 'prof' if profile['kind'] == CPROFILE else 'txt'
+    return f"{profile['created_at']:%Y%m%d-%H%M%S}-{profile['id'][:8]}.{extension}"
+
+
+def profile_summary(profile, limit=40):
+    """Text report: top functions by cumulative time, or the most sampled stacks."""
+    if profile['kind'] == CPROFILE:
+        stream = io.StringIO()
+        stats = pstats.Stats(stream=stream)
+        stats.stats = marshal.loads(profile['data'])
+        stats.get_top_level_stats()
+        stats.sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+    samples = [line.rsplit(' ', 1) for line in profile['data'].decode().splitlines()]
+    total = sum(int(count) for _, count in samples)
+    return '\n\n'.join(
+        f'{int(count) * 100 / total:5.1f}%  ' + '\n        '.join(stack.split(';')[-8:])
+        for stack, count in samples[:limit]
+    )
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.template.base import Node
+from django.utils import timezone
+
+from .metrics import current_request
+
+# Slow-query log.
+#
+# log_slow_queries is an execute wrapper installed on every new connection.
+# A query slower than SLOW_QUERY_THRESHOLD seconds is written to the
+# 'app.slow_queries' logger as one JSON object per line, with its
+# fingerprint, the view, template tag and app code that ran it, and on
+# PostgreSQL sometimes the EXPLAIN (ANALYZE, BUFFERS) plan. EXPLAIN ANALYZE
+# runs the query a second time, so it is only tried for a
+# SLOW_QUERY_EXPLAIN_RATE fraction of slow SELECTs, at most once per
+# fingerprint every SLOW_QUERY_EXPLAIN_INTERVAL seconds in each process.
+# ``manage.py slow_queries`` summarizes the log.
+
+logger = logging.getLogger('app.slow_queries')
+
+APP_DIR = Path(__file__).resolve().parent
+# App modules that only observe queries, never the place one comes from.
+INSTRUMENTATION_MODULES = {'tests.py', 'querylog.py', 'metrics.py', 'middleware.py', 'profiling.py'}
+
+_explained = {}
+_explain_lock = threading.Lock()
+
+
+def fingerprint(sql):
+    """The query with literals and IN lists collapsed, so that variants group together."""
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+\b', '?', sql)
+    sql = re.sub(r'%s', '?', sql)
+    return re.sub(r'(\?, )+\?', '?', sql)
+
+
+def fingerprint_id(sql):
+    return hashlib.md5(fingerprint(sql).encode()).hexdigest()[:12]
+
+
+def call_site(frame):
+    """
+    Where a query came from: the innermost template tag being rendered and
+    the innermost frame of this app's code, from frame outwards.
+    """
+    template = code = None
+    while frame is not None and not (template and code):
+        node = frame.f_locals.get('self')
+        if template is None and frame.f_code.co_name == 'render_annotated' and isinstance(node, Node):
+            template = f'{node.origin.template_name}:{node.token.lineno} {{% {node.token.contents} %}}'
+        filename = Path(frame.f_code.co_filename)
+        if code is None and filename.is_relative_to(APP_DIR) and filename.name not in INSTRUMENTATION_MODULES:
+            code = f'{filename.relative_to(APP_DIR.parent)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return ' / '.join(filter(None, (template, code))) or '?'
+
+
+def _should_explain(connection, sql, many, key):
+    if connection.vendor != 'postgresql' or many:
+        return False
+    if not sql.lstrip().upper().startswith(('SELECT', 'WITH')) or ' FOR UPDATE' in sql.upper():
+        return False
+    if random.random() >= settings.SLOW_QUERY_EXPLAIN_RATE:
+        return False
+    now = time.monotonic()
+    with _explain_lock:
+        if now - _explained.get(key, -settings.SLOW_QUERY_EXPLAIN_INTERVAL) < settings.SLOW_QUERY_EXPLAIN_INTERVAL:
+            return False
+        _explained[key] = now
+    return True
+
+
+def explain(connection, sql, params):
+    """
+    EXPLAIN (ANALYZE, BUFFERS) on a raw cursor, so the execute wrappers do not
+    see it, inside a savepoint when in a transaction so a failure cannot
+    break it.
+    """
+    savepoint = not connection.get_autocommit()
+    with connection.connection.cursor() as cursor:
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT slow_query_explain')
+            cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS) {sql}', params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+            return plan
+        except Exception as e:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            return f'EXPLAIN failed: {e}'
+
+
+def log_slow_queries(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        if duration >= settings.SLOW_QUERY_THRESHOLD:
+            _log(sql, params, many, context['connection'], duration)
+
+
+def _log(sql, params, many, connection, duration):
+    stats = current_request.get()
+    match = stats.request.resolver_match if stats is not None and stats.request is not None else None
+    key = fingerprint_id(sql)
+    entry = {
+        'time': timezone.now().isoformat(),
+        'fingerprint': key,
+        'duration': round(duration, 6),
+        'view': match.view_name if match else None,
+        'call_site': call_site(sys._getframe()),
+        'database': connection.alias,
+        'sql': sql,
+        'plan': None,
+    }
+    if _should_explain(connection, sql, many, key):
+        entry['plan'] = explain(connection, sql, params)
+    logger.warning(json.dumps(entry, ensure_ascii=False))
+
+
+def install_slow_query_log(sender, connection, **kwargs):
+    """connection_created receiver."""
+    if log_slow_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(log_slow_queries)
@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Primary/replica routing.
+#
+# Writes always go to the primary. ReplicaRoutingMiddleware picks one of
+# DATABASE_REPLICAS for each GET/HEAD request and puts it in
+# ``current_routing``; the request's reads go there until it writes or opens
+# a transaction on the primary. A client that wrote is pinned to the primary
+# by a cookie for DATABASE_REPLICA_STICKY_SECONDS, longer than the replicas
+# lag behind, so it reads its own writes. Code running outside a request
+# (celery tasks, management commands) reads from the primary, since what it
+# reads it usually writes back.
+#
+# Whatever is stored under a cache version must be read from the primary
+# (``with primary():``), or a reader on a lagging replica would file
+# pre-change rows under the version that was just bumped. Pages that are
+# only validated by those versions (ETags) cannot all be, so every bump is
+# repeated DATABASE_REPLICA_STICKY_SECONDS later (app.cache), once the
+# replicas have caught up.
+
+current_routing = ContextVar('current_routing', default=None)
+
+
+class Routing:
+    __slots__ = ('replica', 'wrote')
+
+    def __init__(self, replica=None):
+        # None keeps the reads on the primary.
+        self.replica = replica
+        self.wrote = False
+
+
+@contextmanager
+def primary():
+    """Read from the primary inside the block, in requests routed to a replica too."""
+    routing = current_routing.get()
+    if routing is None:
+        yield
+        return
+    replica, routing.replica = routing.replica, None
+    try:
+        yield
+    finally:
+        routing.replica = replica
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        routing = current_routing.get()
+        if routing is None or routing.replica is None or routing.wrote:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return routing.replica
+
+    def db_for_write(self, model, **hints):
+        routing = current_routing.get()
+        if routing is not None:
+            routing.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return False if db in settings.DATABASE_REPLICAS else None
@@ -0,0 +1,184 @@
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVectorField
+from django.db import connection
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import News
+
+# Full-text search over News.
+#
+# PostgreSQL keeps a weighted tsvector in app_news.search_vector, maintained by
+# a trigger and indexed with GIN (migration 0012). SQLite, used in
+# development, keeps an FTS5 table app_news_fts in sync with triggers
+# instead. Neither column nor table is a model field, so queries reach them
+# through raw SQL fragments.
+
+SEARCH_CONFIG = 'russian'
+SEARCH_RESULTS_LIMIT = 20
+
+# Private-use characters mark matches in the database output, so the text
+# can be escaped before the markers are turned into <mark> tags.
+START_SEL = '\ue000'
+STOP_SEL = '\ue001'
+
+SQLITE_FTS_TABLE = 'app_news_fts'
+
+SQLITE_FTS_TRIGGERS = {
+    'app_news_fts_insert': """
+        CREATE TRIGGER IF NOT EXISTS app_news_fts_insert AFTER INSERT ON app_news BEGIN
+            INSERT INTO app_news_fts (rowid, title, news_text) VALUES (new.id, new.title, new.news_text);
+        END
+    """,
+    'app_news_fts_delete': """
+        CREATE TRIGGER IF NOT EXISTS app_news_fts_delete AFTER DELETE ON app_news BEGIN
+            INSERT INTO app_news_fts (app_news_fts, rowid, title, news_text)
+            VALUES ('delete', old.id, old.title, old.news_text);
+        END
+    """,
+    'app_news_fts_update': """
+        CREATE TRIGGER IF NOT EXISTS app_news_fts_update AFTER UPDATE OF title, news_text ON app_news BEGIN
+            INSERT INTO app_news_fts (app_news_fts, rowid, title, news_text)
+            VALUES ('delete', old.id, old.title, old.news_text);
+            INSERT INTO app_news_fts (rowid, title, news_text) VALUES (new.id, new.title, new.news_text);
+        END
+    """,
+}
+
+
+def install_sqlite_search(connection):
+    """
+    Create the FTS5 table and its triggers if they are missing, rebuilding the
+    index when any trigger had to be recreated. SQLite drops triggers when
+    Django remakes app_news during a migration, so this also runs after every
+    migrate.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_FTS_TABLE} "
+            "USING fts5(title, news_text, content='app_news', content_rowid='id')"
+        )
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'app_news'"
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        for sql in SQLITE_FTS_TRIGGERS.values():
+            cursor.execute(sql)
+        if not existing.issuperset(SQLITE_FTS_TRIGGERS):
+            cursor.execute(f"INSERT INTO {SQLITE_FTS_TABLE} ({SQLITE_FTS_TABLE}) VALUES ('rebuild')")
+
+
+def uninstall_sqlite_search(connection):
+    with connection.cursor() as cursor:
+        for name in SQLITE_FTS_TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(f"DROP TABLE IF EXISTS {SQLITE_FTS_TABLE}")
+
+
+def sqlite_search_installed(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [SQLITE_FTS_TABLE]
+        )
+        return cursor.fetchone() is not None
+
+
+def highlight(text):
+    return mark_safe(escape(text or '').replace(START_SEL, '<mark>').replace(STOP_SEL, '</mark>'))
+
+
+def _fts_query(query):
+    # Quote every term so user input is matched literally instead of being
+    # parsed as FTS5 query syntax.
+    return ' '.join('"%s"' % term.replace('"', '""') for term in query.split())
+
+
+def _pg_query(query):
+    return SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch')
+
+
+def _pg_match(query):
+    return RawSQL(
+        f"{News._meta.db_table}.search_vector @@ websearch_to_tsquery(%s::regconfig, %s)",
+        (SEARCH_CONFIG, query),
+        output_field=BooleanField(),
+    )
+
+
+def filter_news(queryset, query):
+    """Restrict a News queryset to the rows matching query, without ranking."""
+    if connection.vendor == 'postgresql':
+        return queryset.filter(_pg_match(query))
+    return queryset.filter(pk__in=RawSQL(
+        f"SELECT rowid FROM {SQLITE_FTS_TABLE} WHERE {SQLITE_FTS_TABLE} MATCH %s", (_fts_query(query),)
+    ))
+
+
+def _search_postgresql(query, limit):
+    vector = RawSQL(f'{News._meta.db_table}.search_vector', (), output_field=SearchVectorField())
+    ranks = dict(
+        News.objects.filter(_pg_match(query))
+        .annotate(rank=SearchRank(vector, _pg_query(query)))
+        .order_by('-rank', '-news_posted_at')
+        .values_list('pk', 'rank')[:limit]
+    )
+    # ts_headline re-parses the whole document, so it only runs for the rows
+    # that made it onto the page.
+    news = News.objects.select_related('category').filter(pk__in=ranks).annotate(
+        title_headline=SearchHeadline(
+            'title', _pg_query(query), config=SEARCH_CONFIG,
+            start_sel=START_SEL, stop_sel=STOP_SEL, highlight_all=True,
+        ),
+        text_headline=SearchHeadline(
+            'news_text', _pg_query(query), config=SEARCH_CONFIG,
+            start_sel=START_SEL, stop_sel=STOP_SEL, min_words=15, max_words=35,
+        ),
+    )
+    results = []
+    for item in news:
+        item.rank = ranks[item.pk]
+        results.append(item)
+    results.sort(key=lambda item: (-item.rank, -item.news_posted_at.timestamp()))
+    return [(item, item.title_headline, item.text_headline) for item in results]
+
+
+def _search_sqlite(query, limit):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid, -bm25({SQLITE_FTS_TABLE}, 10.0, 1.0), "
+            f"highlight({SQLITE_FTS_TABLE}, 0, %s, %s), "
+            f"snippet({SQLITE_FTS_TABLE}, 1, %s, %s, '…', 24) "
+            f"FROM {SQLITE_FTS_TABLE} WHERE {SQLITE_FTS_TABLE} MATCH %s "
+            f"ORDER BY bm25({SQLITE_FTS_TABLE}, 10.0, 1.0) LIMIT %s",
+            [START_SEL, STOP_SEL, START_SEL, STOP_SEL, _fts_query(query), limit],
+        )
+        rows = cursor.fetchall()
+    news = News.objects.select_related('category').in_bulk([row[0] for row in rows])
+    results = []
+    for pk, rank, title, text in rows:
+        if pk in news:
+            news[pk].rank = rank
+            results.append((news[pk], title, text))
+    return results
+
+
+def search_news(query, limit=SEARCH_RESULTS_LIMIT):
+    """
+    Return the News matching query, best match first. Each item has ``rank``,
+    ``title_highlight`` and ``text_highlight`` set, with matches wrapped in
+    <mark>.
+    """
+    query = query.strip()
+    if not query:
+        return []
+    if connection.vendor == 'postgresql':
+        rows = _search_postgresql(query, limit)
+    else:
+        rows = _search_sqlite(query, limit)
+    results = []
+    for news, title, text in rows:
+        news.title_highlight = highlight(title)
+        news.text_highlight = highlight(text)
+        results.append(news)
+    return results
@@ -0,0 +1,147 @@
+from django.db import connections, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .cache import (
+    invalidate_categories, invalidate_comment_counts, invalidate_news_list, invalidate_news_pages, invalidate_user,
+)
+from .images import variant_widths
+from .models import Category, Comment, News, User
+from .search import install_sqlite_search, sqlite_search_installed
+from .task import make_image_variants
+
+
+def after_commit(invalidate, *args):
+    """
+    Run a cache invalidation once the writer's transaction commits. Bumped
+    earlier, a reader between the bump and the commit would cache the old
+    rows under the new version, where they would stay until the next change.
+    """
+    transaction.on_commit(lambda: invalidate(*args))
+
+
+@receiver(pre_save, sender=News)
+def remember_news_category(sender, instance, **kwargs):
+    instance._previous_category_id = (
+        News.objects.filter(pk=instance.pk).values_list('category_id', flat=True).first()
+        if instance.pk else None
+    )
+
+
+@receiver(post_save, sender=News)
+@receiver(post_delete, sender=News)
+def invalidate_news(sender, instance, **kwargs):
+    category_ids = [None, instance.category_id]
+    previous = getattr(instance, '_previous_category_id', None)
+    if previous is not None:
+        category_ids.append(previous)
+    after_commit(invalidate_news_list, *category_ids)
+    after_commit(invalidate_news_pages, instance.pk)
+
+
+def cascaded_from(origin, *models):
+    """Whether a delete signal comes from deleting one of ``models``."""
+    model = getattr(origin, 'model', type(origin))
+    return model in models
+
+
+# The cards on the index show comments_count too. Rather than bump the
+# list versions on every comment, which would throw away the whole index
+# for one number, comments bump the index's comment count version at most
+# once per COMMENT_COUNT_BUMP_DELAY seconds; cards and ETags catch up then.
+@receiver(post_save, sender=Comment)
+def count_comment(sender, instance, created, **kwargs):
+    if created:
+        News.objects.filter(pk=instance.comment_to_news_id).update(comments_count=F('comments_count') + 1)
+        after_commit(invalidate_comment_counts)
+
+
+@receiver(post_delete, sender=Comment)
+def uncount_comment(sender, instance, origin=None, **kwargs):
+    # Deleting a news removes its count with it; deleting a user is counted
+    # once per news by uncount_user_comments.
+    if cascaded_from(origin, News, User):
+        return
+    News.objects.filter(pk=instance.comment_to_news_id, comments_count__gt=0).update(
+        comments_count=F('comments_count') - 1
+    )
+    after_commit(invalidate_comment_counts)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comment(sender, instance, origin=None, **kwargs):
+    if cascaded_from(origin, News, User):
+        return
+    after_commit(invalidate_news_pages, instance.comment_to_news_id)
+
+
+@receiver(pre_delete, sender=User)
+def uncount_user_comments(sender, instance, **kwargs):
+    """
+    Take a deleted user's comments off the counts before they cascade, with a
+    single UPDATE instead of one per comment.
+    """
+    comments = Comment.objects.filter(author=instance).order_by()
+    news_ids = list(comments.values_list('comment_to_news_id', flat=True).distinct())
+    if not news_ids:
+        return
+    count = comments.filter(comment_to_news=OuterRef('pk')).values('comment_to_news').annotate(count=Count('pk'))
+    News.objects.filter(pk__in=news_ids).update(
+        comments_count=Greatest(F('comments_count') - Subquery(count.values('count')), 0)
+    )
+    after_commit(invalidate_news_pages, *news_ids)
+    after_commit(invalidate_comment_counts)
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_comments(sender, instance, created=False, update_fields=None, **kwargs):
+    # Detail pages show the name and photo of every commenter.
+    if created or (update_fields is not None and not {'name', 'image'} & set(update_fields)):
+        return
+    news_ids = Comment.objects.filter(author=instance).values_list('comment_to_news_id', flat=True).distinct()
+    after_commit(invalidate_news_pages, *list(news_ids))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    # request.user comes from the cache (app.backends), and password,
+    # is_active and profile changes all go through save().
+    after_commit(invalidate_user, instance.pk)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category(sender, instance, **kwargs):
+    # Cards render the category name, so both listings that show it go stale.
+    after_commit(invalidate_categories)
+    after_commit(invalidate_news_list, None, instance.pk)
+
+
+@receiver(post_migrate)
+def repair_search_triggers(sender, using, **kwargs):
+    # SQLite loses the FTS triggers whenever a migration remakes app_news.
+    connection = connections[using]
+    if sender.name == 'app' and connection.vendor == 'sqlite' and sqlite_search_installed(connection):
+        install_sqlite_search(connection)
+
+
+def schedule_image_variants(image):
+    widths = variant_widths(image)
+    if image and widths:
+        transaction.on_commit(lambda: make_image_variants.delay(image.name, widths))
+
+
+@receiver(post_save, sender=News)
+def resize_news_image(sender, instance, **kwargs):
+    schedule_image_variants(instance.news_image)
+
+
+@receiver(post_save, sender=User)
+def resize_user_image(sender, instance, update_fields=None, **kwargs):
+    # Logins save the user with update_fields=['last_login'].
+    if update_fields is None or 'image' in update_fields:
+        schedule_image_variants(instance.image)
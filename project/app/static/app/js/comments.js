@@ -0,0 +1,60 @@
+// Progressive enhancement of the comments on the news page. Without
+// JavaScript both still work through full page loads.
+
+// "Показать ещё" appends the next page in place instead of opening it.
+document.addEventListener('click', async (event) => {
+  const link = event.target.closest('.load-more-comments');
+  if (!link) {
+    return;
+  }
+  event.preventDefault();
+  link.classList.add('disabled');
+  try {
+    const response = await fetch(link.dataset.fragmentUrl, {credentials: 'same-origin'});
+    if (!response.ok) {
+      throw new Error(response.statusText);
+    }
+    link.insertAdjacentHTML('afterend', await response.text());
+    link.remove();
+  } catch (error) {
+    window.location.href = link.href;
+  }
+});
+
+// The comment form posts to the comments endpoint, which answers with just
+// the new comment, instead of reloading the whole page.
+const commentForm = document.getElementById('comment-form');
+
+if (commentForm) {
+  commentForm.addEventListener('submit', async (event) => {
+    event.preventDefault();
+    const button = commentForm.querySelector('[type="submit"]');
+    const errors = commentForm.querySelector('.comment-errors') || document.createElement('div');
+    errors.className = 'comment-errors text-danger';
+    errors.textContent = '';
+    button.disabled = true;
+    try {
+      const response = await fetch(commentForm.dataset.fragmentUrl, {
+        method: 'POST',
+        body: new FormData(commentForm),
+        credentials: 'same-origin',
+      });
+      if (response.status === 201) {
+        document.getElementById('comment-list').insertAdjacentHTML('afterbegin', await response.text());
+        const count = document.getElementById('comments-count');
+        count.textContent = Number(count.textContent) + 1;
+        commentForm.reset();
+      } else if (response.status === 400) {
+        const data = await response.json();
+        errors.textContent = Object.values(data.errors).flat().map((error) => error.message).join(' ');
+        commentForm.prepend(errors);
+      } else {
+        commentForm.submit();
+      }
+    } catch (error) {
+      commentForm.submit();
+    } finally {
+      button.disabled = false;
+    }
+  });
+}
@@ -1,25 +1,214 @@
+import logging
+import smtplib
+import time
+from datetime import timedelta
+
 from celery import shared_task
+from django.conf import settings
 from django.contrib.sites.models import Site
-from django.core.mail import EmailMessage
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from django.utils.http import urlsafe_base64_encode
 from django.template.loader import render_to_string
 from django.utils.encoding import force_bytes
 from django.contrib.auth.tokens import default_token_generator
 from django.urls import reverse_lazy
 from .models import *
+from .images import generate_image_variants
+from .cache import bump_comment_count_version, bump_versions, invalidate_news_list, invalidate_news_pages
+from .popularity import pending_views
 
+logger = logging.getLogger(__name__)
 
-@shared_task
-def send_email(pk):
-    user = User.objects.get(pk=pk)
+
+def activation_email(user, domain):
     token = default_token_generator.make_token(user)
     uid = urlsafe_base64_encode(force_bytes(user.pk))
     activation_url = reverse_lazy('activate', kwargs={'uidb64': uid, 'token': token})
-    current_site = Site.objects.get_current().domain
     subject = 'Подтвердите свою почту'
     message = render_to_string('app/account_email.html', {
         'user': user,
-        'link': f'http://{current_site}{activation_url}',
+        'link': f'http://{domain}{activation_url}',
     })
-    email = EmailMessage(subject, message, to=[user.email])
-    email.send()
\ No newline at end of file
+    return EmailMessage(subject, message, to=[user.email])
+
+
+@shared_task
+def send_email(pk):
+    user = User.objects.get(pk=pk)
+    current_site = Site.objects.get_current().domain
+    email = activation_email(user, current_site)
+    email.send()
+    User.objects.filter(pk=pk).update(activation_email_sent_at=timezone.now())
+
+
+def send_with_retry(connection, message):
+    """
+    Send one message over an open connection, reconnecting and retrying up
+    to EMAIL_BATCH_RETRIES times with exponential backoff.
+    """
+    for attempt in range(settings.EMAIL_BATCH_RETRIES + 1):
+        try:
+            if connection.send_messages([message]):
+                return True
+        except (smtplib.SMTPException, OSError):
+            logger.warning('Activation email to %s failed (attempt %s)', message.to, attempt + 1, exc_info=True)
+        if attempt < settings.EMAIL_BATCH_RETRIES:
+            connection.close()
+            time.sleep(settings.EMAIL_BATCH_RETRY_DELAY * 2 ** attempt)
+            try:
+                connection.open()
+            except (smtplib.SMTPException, OSError):
+                logger.warning('Reconnecting to the mail server failed', exc_info=True)
+    return False
+
+
+def claim_activation_emails():
+    """
+    Mark a batch of pending users as being sent to, in a short transaction,
+    and return them. skip_locked lets overlapping flushes split the queue;
+    the claim keeps the rows out of the next flushes while this one sends,
+    until EMAIL_BATCH_CLAIM_TIMEOUT frees those of a flush that died.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        users = list(
+            User.objects.select_for_update(skip_locked=True)
+            .filter(
+                Q(activation_email_claimed_at__isnull=True)
+                | Q(activation_email_claimed_at__lt=now - timedelta(seconds=settings.EMAIL_BATCH_CLAIM_TIMEOUT)),
+                is_active=False,
+                activation_email_sent_at__isnull=True,
+                activation_email_attempts__lt=settings.EMAIL_BATCH_MAX_ATTEMPTS,
+            )
+            .order_by('date_joined')[:settings.EMAIL_BATCH_SIZE]
+        )
+        User.objects.filter(pk__in=[user.pk for user in users]).update(activation_email_claimed_at=now)
+    return users, now
+
+
+@shared_task
+def flush_activation_emails():
+    """
+    Send pending activation emails (EMAIL_BATCHING mode) in one batch over a
+    single SMTP connection, at most EMAIL_BATCH_RATE_LIMIT per second. Users
+    whose email still fails after the retries stay pending for the next
+    flush, until EMAIL_BATCH_MAX_ATTEMPTS flushes have failed. No transaction
+    is open while sending: the batch is claimed first, and the results are
+    recorded once it is through.
+    """
+    interval = 1 / settings.EMAIL_BATCH_RATE_LIMIT if settings.EMAIL_BATCH_RATE_LIMIT else 0
+    users, claimed_at = claim_activation_emails()
+    if not users:
+        return 0
+    current_site = Site.objects.get_current().domain
+    sent, failed = [], []
+    try:
+        with get_connection() as connection:
+            for user in users:
+                started = time.monotonic()
+                if send_with_retry(connection, activation_email(user, current_site)):
+                    sent.append(user.pk)
+                else:
+                    failed.append(user.pk)
+                time.sleep(max(0, interval - (time.monotonic() - started)))
+    finally:
+        with transaction.atomic():
+            User.objects.filter(pk__in=sent).update(
+                activation_email_sent_at=timezone.now(), activation_email_claimed_at=None,
+            )
+            User.objects.filter(pk__in=failed, activation_email_claimed_at=claimed_at).update(
+                activation_email_attempts=F('activation_email_attempts') + 1, activation_email_claimed_at=None,
+            )
+            # Not tried because the connection failed: back in the queue.
+            User.objects.filter(pk__in=[user.pk for user in users], activation_email_claimed_at=claimed_at).update(
+                activation_email_claimed_at=None,
+            )
+    return len(sent)
+
+
+@shared_task
+def rebump_versions(*keys):
+    """Bump cache versions again once the read replicas have caught up with the change."""
+    bump_versions(*keys)
+
+
+@shared_task
+def bump_comment_counts():
+    """Refresh the comment counts on the news index, see app.cache.invalidate_comment_counts."""
+    bump_comment_count_version()
+
+
+@shared_task
+def make_image_variants(name, widths):
+    """
+    Write the variants of an uploaded image, then refresh the cached pages
+    showing it, which went out with the original until now: the news it
+    illustrates, with their listings, and the news its owner commented on.
+    """
+    if not generate_image_variants(name, widths):
+        return
+    categories = dict(News.objects.filter(news_image=name).values_list('pk', 'category_id'))
+    commented = Comment.objects.filter(author__image=name).values_list('comment_to_news_id', flat=True).distinct()
+    news_ids = {*categories, *commented}
+    if categories:
+        transaction.on_commit(lambda: invalidate_news_list(None, *categories.values()))
+    if news_ids:
+        transaction.on_commit(lambda: invalidate_news_pages(*news_ids))
+
+
+@shared_task
+def reconcile_comment_counts(batch_size=None):
+    """
+    Repair News.comments_count wherever it no longer matches the comments,
+    e.g. after bulk inserts or raw SQL. Each batch of news is recounted by a
+    single UPDATE in the database, so comments written meanwhile still count.
+    Returns the number of news fixed.
+    """
+    batch_size = batch_size or settings.COMMENT_COUNT_RECONCILE_BATCH_SIZE
+    actual = Coalesce(Subquery(
+        Comment.objects.filter(comment_to_news=OuterRef('pk')).order_by()
+        .values('comment_to_news').annotate(count=Count('pk')).values('count')
+    ), 0)
+    fixed = {}
+    last_pk = 0
+    while True:
+        pks = list(News.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        drifted = dict(
+            News.objects.filter(pk__in=pks).annotate(actual=actual)
+            .exclude(comments_count=F('actual')).values_list('pk', 'category_id')
+        )
+        if drifted:
+            News.objects.filter(pk__in=drifted).update(comments_count=actual)
+            fixed.update(drifted)
+    if fixed:
+        logger.warning('Fixed comments_count of %d news', len(fixed))
+        invalidate_news_pages(*fixed)
+        invalidate_news_list(None, *set(fixed.values()))
+    return len(fixed)
+
+
+@shared_task
+def flush_view_counts(batch_size=None):
+    """
+    Add the views counted in Redis since the last run to News.views_count
+    and News.unique_views, with one UPDATE per batch_size news. The counts
+    are not shown on the cached pages, so nothing is invalidated. Returns
+    the number of news updated.
+    """
+    batch_size = batch_size or settings.VIEW_COUNT_FLUSH_BATCH_SIZE
+    with pending_views() as counts, transaction.atomic():
+        pks = sorted(counts)
+        for start in range(0, len(pks), batch_size):
+            batch = pks[start:start + batch_size]
+            News.objects.filter(pk__in=batch).update(
+                views_count=F('views_count') + Case(*(When(pk=pk, then=Value(counts[pk][0])) for pk in batch)),
+                unique_views=F('unique_views') + Case(*(When(pk=pk, then=Value(counts[pk][1])) for pk in batch)),
+            )
+    return len(counts)
@@ -0,0 +1,55 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html, format_html_join
+
+from ..images import VARIANT_FORMATS, ready_variants, variant_name, variant_widths
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def responsive_image(context, image, sizes='100vw', **attrs):
+    """
+    Render an uploaded image as a <picture> with WebP and JPEG srcsets of its
+    resized variants. Until the variants have been generated, or for fields
+    without any, the original upload is used. Readiness comes from the
+    ``image_variants`` the view put in the context (app.images), or is
+    looked up for this image alone.
+
+    Usage: {% responsive_image news.news_image sizes="60vw" id="lox228" %}
+    """
+    if not image:
+        return ''
+    attributes = format_html_join('', ' {}="{}"', attrs.items())
+    widths = variant_widths(image)
+    variants = context.get('image_variants') or {}
+    if not widths:
+        ready = {}
+    elif image.name in variants:
+        ready = variants[image.name]
+    else:
+        ready = ready_variants(image.name, widths)
+    if not ready:
+        return format_html('<img src="{}"{}>', image.url, attributes)
+    # Variants of a small upload are narrower than their nominal width, and
+    # several may share the upload's own; list each actual width once.
+    candidates = {}
+    for width in sorted(ready):
+        candidates.setdefault(ready[width], width)
+
+    def srcset(extension):
+        return ', '.join(
+            f'{default_storage.url(variant_name(image.name, width, extension))} {actual}w'
+            for actual, width in candidates.items()
+        )
+
+    sources = format_html_join(
+        '', '<source type="{}" srcset="{}" sizes="{}">',
+        ((mime, srcset(extension), sizes) for _, extension, mime in VARIANT_FORMATS[:-1]),
+    )
+    _, extension, _ = VARIANT_FORMATS[-1]
+    fallback = default_storage.url(variant_name(image.name, max(widths), extension))
+    return format_html(
+        '<picture class="responsive-image">{}<img src="{}" srcset="{}" sizes="{}"{}></picture>',
+        sources, fallback, srcset(extension), sizes, attributes,
+    )
@@ -1,3 +1,1342 @@
-from django.test import TestCase
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+from importlib import import_module
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import redis
+from django.apps import apps as global_apps
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import InMemoryStorage
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, connections
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, reverse
+from django.utils import timezone
+from django.utils.http import http_date, urlsafe_base64_encode
+from PIL import Image
+
+from project.urls import urlpatterns as project_urlpatterns
+
+from . import metrics, popularity, querylog, views
+from .cache import bump_comment_count_version, categories, news_list_validators
+from .images import generate_image_variants, ready_variants
+from .management.commands.loadtest import percentile
+from .media import if_range_matches, parse_range
+from .metrics import PROCESSES_KEY, Collected, Histogram, SharedStore, render_metrics
+from .metrics import Counter as MetricCounter
+from .models import Category, Comment, News, User, news_excerpt
+from .pagination import InvalidCursor, KeysetPaginator
+from .profiling import StackSampler
+from .querylog import call_site, fingerprint
+from .search import search_news
+from .task import claim_activation_emails, flush_activation_emails, flush_view_counts, make_image_variants
+from .templatetags.images import responsive_image
+
+# The async views are only routed when ASYNC_VIEWS is set, so they get their
+# own URLconf (this module) that shadows the sync ones under the same names.
+urlpatterns = [
+    path('news/', include([
+        path('main/<int:pk>', views.AsyncNewsDetailView.as_view(), name='detail_news'),
+        path('main/<int:pk>/comments', views.AsyncNewsCommentsView.as_view(), name='news_comments'),
+        path('main/', views.AsyncNewsListView.as_view(), name='main'),
+    ])),
+    *project_urlpatterns,
+]
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class QueryRecorder:
+    """Database execute wrapper that records every query along with its call site."""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append((sql, call_site(sys._getframe(1))))
+        return execute(sql, params, many, context)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES, ASYNC_VIEWS=False, EMAIL_BATCHING=True, VIEW_COUNTING=False, METRICS_REDIS_URL='',
+)
+class QueryBudgetTests(TestCase):
+    """
+    Every page must run the same number of queries whatever the amount of
+    data it shows. Each page is requested against data seeded at SIZES rows
+    (news in a category, comments on a news, users), with an empty cache so
+    the cold path is measured; a count that changes with the size is an N+1,
+    reported with the templates and code that issued the extra queries.
+    """
+
+    # Below the news index page size, so every row is rendered.
+    SIZES = (1, 4, 12)
+
+    def setUp(self):
+        self.user = User.objects.create_user('reader@example.com', 'password', name='Читатель')
+        self.admin = User.objects.create_superuser('admin@example.com', 'password', name='Админ', age=30)
+        self.category = Category.objects.create(name='Политика')
+        self.news = News.objects.create(
+            title='Первая новость', news_text='Текст новости', news_image='news/test.jpg', category=self.category,
+        )
+        self.comment = Comment.objects.create(author=self.user, comment_text='Комментарий', comment_to_news=self.news)
+        self.size = 1
+
+    def grow(self, size):
+        """Add rows until there are size of everything the pages list."""
+        count = size - self.size
+        if count <= 0:
+            return
+        News.objects.bulk_create(
+            News(
+                title=f'Новость {self.size + i}', news_text='Текст новости', news_image='news/test.jpg',
+                category=self.category if i % 2 else None,
+            )
+            for i in range(count)
+        )
+        News.objects.filter(category=None).update(category=self.category)
+        users = [
+            User.objects.create_user(f'user{self.size + i}@example.com', name=f'Автор {i}', image='images/test.jpg')
+            for i in range(count)
+        ]
+        Comment.objects.bulk_create(
+            Comment(author=user, comment_text='Комментарий', comment_to_news=self.news) for user in users
+        )
+        self.size = size
+
+    def record(self, url, user=None):
+        cache.clear()
+        self.client.logout()
+        if user is not None:
+            self.client.force_login(user)
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            response = self.client.get(url)
+        self.assertLess(response.status_code, 500, url)
+        return recorder.queries
+
+    def assertQueryBudget(self, url, user=None):
+        # Warm up the process-wide caches (sites, content types) first.
+        self.record(url, user)
+        runs = {}
+        for size in self.SIZES:
+            self.grow(size)
+            runs[size] = self.record(url, user)
+        counts = {size: len(queries) for size, queries in runs.items()}
+        if len(set(counts.values())) > 1:
+            self.fail(self.report(url, counts, runs))
+
+    def report(self, url, counts, runs):
+        smallest, largest = runs[min(runs)], runs[max(runs)]
+        before = Counter((fingerprint(sql), origin) for sql, origin in smallest)
+        after = Counter((fingerprint(sql), origin) for sql, origin in largest)
+        lines = [
+            f'{url}: query count depends on the data size '
+            f'({", ".join(f"{size} rows: {count}" for size, count in counts.items())}).',
+            'Queries that grew:',
+        ]
+        for (sql, origin), count in (after - before).most_common():
+            lines.append(f'  +{count} from {origin}\n      {sql[:300]}')
+        return '\n'.join(lines)
+
+    def test_news_list(self):
+        self.assertQueryBudget(reverse('main'))
+        self.assertQueryBudget(reverse('main'), self.user)
+        self.assertQueryBudget(f"{reverse('main')}?category={self.category.pk}")
+
+    def test_news_detail(self):
+        url = reverse('detail_news', kwargs={'pk': self.news.pk})
+        self.assertQueryBudget(url)
+        self.assertQueryBudget(url, self.user)
+
+    def test_news_comments(self):
+        url = reverse('news_comments', kwargs={'pk': self.news.pk})
+        self.assertQueryBudget(url, self.user)
+        self.assertQueryBudget(f'{url}?format=json')
+
+    @override_settings(ROOT_URLCONF='app.tests')
+    def test_async_news_list(self):
+        self.assertQueryBudget(reverse('main'), self.user)
+        self.assertQueryBudget(f"{reverse('main')}?category={self.category.pk}")
+
+    @override_settings(ROOT_URLCONF='app.tests')
+    def test_async_news_detail(self):
+        self.assertQueryBudget(reverse('detail_news', kwargs={'pk': self.news.pk}), self.user)
+        self.assertQueryBudget(reverse('news_comments', kwargs={'pk': self.news.pk}), self.user)
+
+    def test_search(self):
+        self.assertQueryBudget(f"{reverse('search')}?q=новость")
+
+    def test_comment_pages(self):
+        kwargs = {'pk': self.news.pk}
+        self.assertQueryBudget(reverse('comment_change', kwargs={**kwargs, 'comment': self.comment.pk}), self.user)
+        self.assertQueryBudget(reverse('comment_delete', kwargs={**kwargs, 'del_comment': self.comment.pk}), self.user)
+
+    def test_account_pages(self):
+        for name in ('login', 'registration', 'account_sent', 'account_complete'):
+            with self.subTest(name):
+                self.assertQueryBudget(reverse(name))
+        self.assertQueryBudget(reverse('activate', kwargs={'uidb64': 'MQ', 'token': 'invalid'}))
+
+    def test_profile_pages(self):
+        kwargs = {'pk': self.user.pk}
+        for name in ('profile', 'update', 'password_change', 'password_change_done', 'image'):
+            with self.subTest(name):
+                self.assertQueryBudget(reverse(name, kwargs=kwargs), self.user)
+        self.assertQueryBudget(reverse('user_logout'), self.user)
+
+    def test_admin_changelists(self):
+        for model in (News, Comment, User, Category):
+            with self.subTest(model._meta.model_name):
+                self.assertQueryBudget(
+                    reverse(f'admin:{model._meta.app_label}_{model._meta.model_name}_changelist'), self.admin,
+                )
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ASYNC_VIEWS=False, VIEW_COUNTING=False, METRICS_REDIS_URL='')
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('reader@example.com', 'password', name='Читатель')
+        self.news = News.objects.create(title='Новость', news_text='Текст новости')
+        self.urls = [
+            reverse('main'), reverse('detail_news', kwargs={'pk': self.news.pk}),
+            reverse('news_comments', kwargs={'pk': self.news.pk}),
+        ]
+
+    def etags(self):
+        return [self.client.get(url)['ETag'] for url in self.urls]
+
+    def test_matching_validators_answer_304_without_queries(self):
+        for url in self.urls:
+            response = self.client.get(url)
+            for headers in (
+                {'HTTP_IF_NONE_MATCH': response['ETag']},
+                {'HTTP_IF_MODIFIED_SINCE': response['Last-Modified']},
+            ):
+                with self.subTest(url=url, headers=list(headers)), self.assertNumQueries(0):
+                    self.assertEqual(self.client.get(url, **headers).status_code, 304)
+            stale = self.client.get(url, HTTP_IF_NONE_MATCH='"0-0-0"')
+            self.assertEqual(stale.status_code, 200)
+
+    def test_saving_the_news_changes_every_etag(self):
+        before = self.etags()
+        self.news.title = 'Другая новость'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.news.save()
+        after = self.etags()
+        for url, old, new in zip(self.urls, before, after):
+            with self.subTest(url=url):
+                self.assertNotEqual(old, new)
+
+    def test_comments_change_every_etag(self):
+        before = self.etags()
+        with mock.patch('app.task.bump_comment_counts') as bump, self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(author=self.user, comment_text='Комментарий', comment_to_news=self.news)
+        # The news pages change at once, the index once the delayed bump runs.
+        self.assertEqual(self.etags()[0], before[0])
+        bump.apply_async.assert_called_once()
+        bump_comment_count_version()
+        after = self.etags()
+        for url, old, new in zip(self.urls, before, after):
+            with self.subTest(url=url):
+                self.assertNotEqual(old, new)
+        self.assertContains(self.client.get(self.urls[0]), 'Комментариев: 1')
+
+    def test_etag_depends_on_the_reader(self):
+        anonymous = self.etags()
+        self.client.force_login(self.user)
+        for url, old, new in zip(self.urls, anonymous, self.etags()):
+            with self.subTest(url=url):
+                self.assertNotEqual(old, new)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, VIEW_COUNTING=False, METRICS_REDIS_URL='')
+class CachedUserTests(TestCase):
+    """request.user comes from the cache until the user is saved again."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('reader@example.com', 'password', name='Читатель')
+        self.client.force_login(self.user)
+        self.url = reverse('main')
+
+    def test_user_is_cached(self):
+        self.client.get(self.url)
+        recorder = QueryRecorder()
+        with connection.execute_wrapper(recorder):
+            self.client.get(self.url)
+        self.assertFalse([sql for sql, _ in recorder.queries if 'FROM "app_user"' in sql])
+
+    def test_profile_change_reloads_user(self):
+        self.client.get(self.url)
+        self.user.name = 'Писатель'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save(update_fields=['name'])
+        self.assertEqual(self.client.get(self.url).wsgi_request.user.name, 'Писатель')
+
+    def test_password_is_not_cached(self):
+        self.client.get(self.url)
+        entry = cache.get(f'user:{self.user.pk}')
+        self.assertNotIn('password', entry['fields'])
+        self.assertNotIn(self.user.password, repr(entry))
+        user = self.client.get(self.url).wsgi_request.user
+        self.assertIn('password', user.get_deferred_fields())
+        # Saving the cached user leaves the password alone.
+        user.name = 'Писатель'
+        user.save()
+        self.assertTrue(User.objects.get().check_password('password'))
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+    def test_sessions_of_the_previous_backend_are_moved(self):
+        session = SessionStore()
+        session.update({
+            SESSION_KEY: str(self.user.pk),
+            BACKEND_SESSION_KEY: 'django.contrib.auth.backends.ModelBackend',
+            HASH_SESSION_KEY: self.user.get_session_auth_hash(),
+        })
+        session.create()
+        import_module('app.migrations.0018_session_auth_backend').forwards(global_apps, None)
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        self.assertTrue(self.client.get(self.url).wsgi_request.user.is_authenticated)
+
+    def test_password_change_logs_out(self):
+        self.client.get(self.url)
+        self.user.set_password('another-password')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save(update_fields=['password'])
+        self.assertFalse(self.client.get(self.url).wsgi_request.user.is_authenticated)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, LOOKUP_CACHE_LOCAL_TIMEOUT=10)
+class LookupTableTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category = Category.objects.create(name='Политика')
+
+    def test_reads_are_served_from_the_process(self):
+        categories.all()
+        with self.assertNumQueries(0):
+            self.assertEqual(categories.get(self.category.pk).name, 'Политика')
+            self.assertIsNone(categories.get(self.category.pk + 1))
+
+    def test_other_processes_see_changes_after_the_local_timeout(self):
+        categories.all()
+        # A save in another process only bumps the shared version.
+        Category.objects.filter(pk=self.category.pk).update(name='Экономика')
+        cache.set(categories.version_key, time.time_ns(), None)
+        self.assertEqual(categories.get(self.category.pk).name, 'Политика')
+        with mock.patch('app.cache.time.monotonic', return_value=time.monotonic() + 10):
+            self.assertEqual(categories.get(self.category.pk).name, 'Экономика')
+
+    def test_save_invalidates_on_commit(self):
+        categories.all()
+        self.category.name = 'Экономика'
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.category.save()
+            # Until the save commits, readers keep the old rows and version.
+            self.assertEqual(categories.get(self.category.pk).name, 'Политика')
+        for callback in callbacks:
+            callback()
+        self.assertEqual(categories.get(self.category.pk).name, 'Экономика')
+
+
+class KeysetPaginatorTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        # Two pairs posted at the same instant, ordered by pk among themselves.
+        posted = [now, now - timedelta(minutes=1), now - timedelta(minutes=1), now - timedelta(minutes=2)] * 2
+        News.objects.bulk_create(
+            News(title=f'Новость {i}', news_text='Текст новости', news_posted_at=at - timedelta(hours=i // 4))
+            for i, at in enumerate(posted)
+        )
+        self.paginator = KeysetPaginator(News.objects.all(), 3, 'news_posted_at')
+        self.expected = list(News.objects.order_by('-news_posted_at', '-pk').values_list('pk', flat=True))
+
+    def test_pages_cover_every_row_once(self):
+        pks, cursor, pages = [], None, 0
+        while True:
+            page = self.paginator.page(cursor)
+            pks.extend(news.pk for news in page)
+            pages += 1
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        self.assertEqual(pks, self.expected)
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(page), 2)
+
+    def test_cursor_round_trip(self):
+        news = News.objects.get(pk=self.expected[1])
+        cursor = self.paginator.encode_cursor(news)
+        self.assertEqual(self.paginator.decode_cursor(cursor), (news.news_posted_at, news.pk))
+        self.assertEqual([item.pk for item in self.paginator.page(cursor)], self.expected[2:5])
+
+    def test_invalid_cursors_fall_back_to_the_first_page(self):
+        first_page = [news.pk for news in self.paginator.page()]
+        for cursor in ('garbage', urlsafe_base64_encode(b'2026-01-01T00:00:00|x'), urlsafe_base64_encode(b'yesterday|1')):
+            with self.subTest(cursor=cursor):
+                self.assertFalse(self.paginator.is_valid_cursor(cursor))
+                with self.assertRaises(InvalidCursor):
+                    self.paginator.page(cursor)
+                self.assertEqual([news.pk for news in self.paginator.get_page(cursor)], first_page)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ASYNC_VIEWS=False, VIEW_COUNTING=False, METRICS_REDIS_URL='')
+class ExcerptTests(TestCase):
+    text = ' '.join(f'слово{i}' for i in range(30))
+
+    def test_save_refreshes_the_excerpt(self):
+        news = News.objects.create(title='Новость', news_text=self.text)
+        self.assertEqual(news.excerpt, news_excerpt(self.text))
+        self.assertTrue(news.excerpt.startswith('слово0 слово1'))
+        self.assertNotIn('слово20', news.excerpt)
+
+        news.news_text = 'Новый текст'
+        news.save(update_fields=['news_text'])
+        news.refresh_from_db()
+        self.assertEqual(news.excerpt, 'Новый текст')
+
+        news.news_text = 'Ещё один текст'
+        news.save()
+        news.refresh_from_db()
+        self.assertEqual(news.excerpt, 'Ещё один текст')
+
+    def test_save_without_news_text_keeps_the_excerpt(self):
+        news = News.objects.create(title='Новость', news_text='Старый текст')
+        news.news_text = 'Несохранённый текст'
+        news.title = 'Другая новость'
+        news.save(update_fields=['title'])
+        news.refresh_from_db()
+        self.assertEqual(news.excerpt, 'Старый текст')
+
+    def test_backfill_fills_empty_excerpts_in_batches(self):
+        for i in range(5):
+            News.objects.create(title=f'Новость {i}', news_text=f'Текст {i}')
+        News.objects.filter(title__in=['Новость 0', 'Новость 3']).update(excerpt='')
+        News.objects.filter(title='Новость 4').update(excerpt='Свой анонс')
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('backfill_excerpts', batch_size=1, stdout=out)
+        self.assertIn('Filled the excerpt of 2 news.', out.getvalue())
+        self.assertEqual(
+            dict(News.objects.values_list('title', 'excerpt')),
+            {'Новость 0': 'Текст 0', 'Новость 1': 'Текст 1', 'Новость 2': 'Текст 2',
+             'Новость 3': 'Текст 3', 'Новость 4': 'Свой анонс'},
+        )
+        # Two one-row batches, then the empty read that ends the loop.
+        selects = [q['sql'] for q in queries if q['sql'].startswith('SELECT') and 'app_news' in q['sql']]
+        self.assertEqual(len([sql for sql in selects if 'LIMIT 1' in sql]), 3)
+
+        call_command('backfill_excerpts', all=True, stdout=out)
+        self.assertEqual(News.objects.get(title='Новость 4').excerpt, 'Текст 4')
+
+    def test_index_does_not_select_news_text(self):
+        News.objects.create(title='Новость', news_text=self.text)
+        self.assertNotIn('news_text', str(views.NewsListView().get_queryset().query))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('main'))
+        self.assertContains(response, 'слово0 слово1')
+        self.assertFalse([q['sql'] for q in queries if 'news_text' in q['sql']])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ASYNC_VIEWS=False, VIEW_COUNTING=False, METRICS_REDIS_URL='')
+class SearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.body_match = News.objects.create(
+            title='Погода на неделю', news_text='Синоптики обещают дожди, а выборы пройдут в воскресенье.',
+        )
+        self.title_match = News.objects.create(title='Выборы <мэра> & депутатов', news_text='Итоги голосования.')
+
+    def test_title_matches_rank_first(self):
+        results = search_news('выборы')
+        self.assertEqual(results, [self.title_match, self.body_match])
+        self.assertGreater(results[0].rank, results[1].rank)
+
+    def test_matches_are_marked_and_the_rest_escaped(self):
+        news = search_news('выборы')[0]
+        self.assertEqual(news.title_highlight, '<mark>Выборы</mark> &lt;мэра&gt; &amp; депутатов')
+        news = search_news('выборы')[1]
+        self.assertIn('<mark>выборы</mark>', news.text_highlight)
+        self.assertNotIn('<mark>', news.title_highlight)
+
+    def test_query_syntax_is_matched_literally(self):
+        # Unquoted, OR would return both news and the others would be syntax errors.
+        self.assertEqual(search_news('выборы OR погода'), [])
+        for query in ('title:погода', 'выборы NOT погода', 'NEAR(выборы', '"выборы', 'выбор*', '-погода', '^выборы'):
+            with self.subTest(query=query):
+                search_news(query)
+        self.assertEqual(search_news('"выборы"'), search_news('выборы'))
+        self.assertEqual(search_news('   '), [])
+
+    def test_search_page(self):
+        response = self.client.get(reverse('search'), {'q': 'выборы'})
+        self.assertContains(response, '<mark>Выборы</mark> &lt;мэра&gt; &amp; депутатов', html=False)
+        self.assertEqual(list(response.context['results']), [self.title_match, self.body_match])
+
+    def test_admin_search(self):
+        admin = User.objects.create_superuser('admin@example.com', 'password', name='Админ', age=30)
+        self.client.force_login(admin)
+        url = reverse('admin:app_news_changelist')
+        response = self.client.get(url, {'q': 'выборы'})
+        self.assertEqual(set(response.context['cl'].result_list), {self.title_match, self.body_match})
+        response = self.client.get(url, {'q': 'дожди'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.body_match])
+        response = self.client.get(url, {'q': 'title:погода'})
+        self.assertEqual(list(response.context['cl'].result_list), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ASYNC_VIEWS=False, VIEW_COUNTING=False, METRICS_REDIS_URL='')
+class NewsListUrlTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.category = Category.objects.create(name='Политика')
+        self.news = News.objects.create(title='В категории', news_text='Текст новости', category=self.category)
+        self.other = News.objects.create(title='Без категории', news_text='Текст новости')
+        self.url = reverse('main')
+
+    def test_non_canonical_urls_redirect_permanently(self):
+        cursor = KeysetPaginator(News.objects.all(), 1, 'news_posted_at').encode_cursor(self.news)
+        canonical = f'{self.url}?category={self.category.pk}&cursor={cursor}'
+        cases = {
+            f'{self.url}?cursor=garbage': self.url,
+            f'{self.url}?category=0': self.url,
+            f'{self.url}?category=abc&cursor=garbage': self.url,
+            f'{self.url}?cursor={cursor}&category={self.category.pk}': canonical,
+        }
+        for url, target in cases.items():
+            with self.subTest(url=url):
+                self.assertRedirects(self.client.get(url), target, status_code=301, fetch_redirect_response=False)
+        self.assertEqual(self.client.get(canonical).status_code, 200)
+
+    def test_category_filter(self):
+        response = self.client.get(f'{self.url}?category={self.category.pk}')
+        self.assertContains(response, 'В категории')
+        self.assertNotContains(response, 'Без категории')
+        self.assertContains(self.client.get(self.url), 'Без категории')
+
+    def test_filter_form_redirects_to_the_get_url(self):
+        response = self.client.post(self.url, {'filtering': self.category.pk})
+        self.assertRedirects(response, f'{self.url}?category={self.category.pk}', fetch_redirect_response=False)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ASYNC_VIEWS=False, METRICS_REDIS_URL='')
+class CommentPostTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('reader@example.com', 'password', name='Читатель')
+        self.news = News.objects.create(title='Новость', news_text='Текст новости')
+        self.url = reverse('news_comments', kwargs={'pk': self.news.pk})
+
+    def test_anonymous_users_are_refused(self):
+        response = self.client.post(self.url, {'comment_text': 'Комментарий'})
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Comment.objects.exists())
+
+    def test_invalid_comment(self):
+        self.client.force_login(self.user)
+        response = self.client.post(self.url, {'comment_text': ''})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('comment_text', response.json()['errors'])
+
+    def test_comment_is_created(self):
+        self.client.force_login(self.user)
+        response = self.client.post(f'{self.url}?format=json', {'comment_text': 'Комментарий'})
+        self.assertEqual(response.status_code, 201)
+        comment = Comment.objects.get()
+        self.assertEqual((comment.author, comment.comment_to_news), (self.user, self.news))
+        self.assertEqual(response.json()['id'], comment.pk)
+        self.assertEqual(News.objects.get().comments_count, 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ASYNC_VIEWS=False, METRICS_REDIS_URL='')
+class MissingNewsCommentTests(TransactionTestCase):
+    """The foreign key is only checked on commit, so it needs real transactions."""
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('app.signals.make_image_variants')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_comment_on_a_missing_news_is_404(self):
+        user = User.objects.create_user('reader@example.com', 'password', name='Читатель')
+        self.client.force_login(user)
+        response = self.client.post(reverse('news_comments', kwargs={'pk': 404}), {'comment_text': 'Комментарий'})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Comment.objects.exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ImageVariantTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.storage = InMemoryStorage()
+        buffer = BytesIO()
+        Image.new('RGB', (200, 100)).save(buffer, 'JPEG')
+        self.storage.save('images/small.jpg', ContentFile(buffer.getvalue()))
+
+    def test_readiness_is_recorded_with_the_actual_widths(self):
+        self.assertEqual(ready_variants('images/small.jpg', (100, 200, 320), self.storage), {})
+        generate_image_variants('images/small.jpg', (100, 200, 320), self.storage)
+        with mock.patch.object(self.storage, 'exists') as exists:
+            ready = ready_variants('images/small.jpg', (100, 200, 320), self.storage)
+        exists.assert_not_called()
+        self.assertEqual(ready, {100: 100, 200: 200, 320: 200})
+
+    def test_srcset_lists_actual_widths(self):
+        image = User(image='images/small.jpg').image
+        with mock.patch('app.templatetags.images.ready_variants', return_value={100: 100, 200: 200, 320: 200}):
+            html = responsive_image({}, image)
+        self.assertIn('variants/images/small_100.jpg 100w, /media/variants/images/small_200.jpg 200w"', html)
+        self.assertNotIn('small_320.jpg 320w', html)
+
+
+class ImageVariantPagesTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Политика')
+        self.user = User.objects.create_user('reader@example.com', 'password', name='Читатель', image='images/me.jpg')
+        self.news = News.objects.create(
+            title='Новость', news_text='Текст новости', news_image='news/a.jpg', category=self.category,
+        )
+        self.commented = News.objects.create(title='Другая', news_text='Текст новости')
+        Comment.objects.create(author=self.user, comment_text='Комментарий', comment_to_news=self.commented)
+
+    def make_variants(self, name, written=True):
+        with mock.patch('app.task.generate_image_variants', return_value=written), \
+                mock.patch('app.task.invalidate_news_list') as invalidate_list, \
+                mock.patch('app.task.invalidate_news_pages') as invalidate_pages, \
+                self.captureOnCommitCallbacks(execute=True):
+            make_image_variants(name, (320,))
+        return invalidate_list, invalidate_pages
+
+    def test_news_image_refreshes_its_pages_and_listings(self):
+        invalidate_list, invalidate_pages = self.make_variants('news/a.jpg')
+        invalidate_list.assert_called_once_with(None, self.category.pk)
+        invalidate_pages.assert_called_once_with(self.news.pk)
+
+    def test_avatar_refreshes_the_news_commented_on(self):
+        invalidate_list, invalidate_pages = self.make_variants('images/me.jpg')
+        invalidate_list.assert_not_called()
+        invalidate_pages.assert_called_once_with(self.commented.pk)
+
+    def test_nothing_to_refresh_when_the_variants_existed(self):
+        invalidate_list, invalidate_pages = self.make_variants('news/a.jpg', written=False)
+        invalidate_list.assert_not_called()
+        invalidate_pages.assert_not_called()
+
+
+@override_settings(CACHES=LOCMEM_CACHES, ASYNC_VIEWS=False, VIEW_COUNTING=False, METRICS_REDIS_URL='')
+class PageImageVariantsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.news = News.objects.create(title='Новость', news_text='Текст новости', news_image='news/a.jpg')
+        for i in range(3):
+            author = User.objects.create_user(f'user{i}@example.com', 'password', name=f'Автор {i}', image=f'images/{i}.jpg')
+            Comment.objects.create(author=author, comment_text='Комментарий', comment_to_news=self.news)
+
+    def test_pages_look_up_their_images_at_once(self):
+        urls = [
+            reverse('main'), reverse('detail_news', kwargs={'pk': self.news.pk}),
+            reverse('news_comments', kwargs={'pk': self.news.pk}),
+        ]
+        for url in urls:
+            with self.subTest(url=url), mock.patch('app.images.variants_ready', return_value=False), \
+                    mock.patch('app.templatetags.images.ready_variants') as ready_variants, \
+                    mock.patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            ready_variants.assert_not_called()
+            lookups = [
+                keys for (keys, *_), _ in get_many.call_args_list if any(key.startswith('image_variants:') for key in keys)
+            ]
+            self.assertEqual(len(lookups), 1)
+
+    @override_settings(ROOT_URLCONF='app.tests')
+    def test_async_pages_look_up_their_images_before_rendering(self):
+        urls = [
+            reverse('main'), reverse('detail_news', kwargs={'pk': self.news.pk}),
+            reverse('news_comments', kwargs={'pk': self.news.pk}),
+        ]
+        for url in urls:
+            with self.subTest(url=url), mock.patch('app.images.variants_ready', return_value=False), \
+                    mock.patch('app.templatetags.images.ready_variants') as ready_variants, \
+                    mock.patch.object(cache, 'aget_many', wraps=cache.aget_many) as aget_many:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            ready_variants.assert_not_called()
+            lookups = [
+                keys for (keys, *_), _ in aget_many.call_args_list if any(key.startswith('image_variants:') for key in keys)
+            ]
+            self.assertEqual(len(lookups), 1)
+
+
+class RangeTests(SimpleTestCase):
+    def test_parse_range(self):
+        cases = {
+            'bytes=0-99': (0, 100),
+            'bytes=100-': (100, 1000),
+            'bytes=990-2000': (990, 1000),
+            'bytes=-100': (900, 1000),
+            'bytes=-2000': (0, 1000),
+            'bytes=0-0': (0, 1),
+            'bytes=1000-': False,
+            'bytes=-0': False,
+            'bytes=5-4': None,
+            'bytes=-': None,
+            'bytes=0-1,5-6': None,
+            'items=0-1': None,
+            '': None,
+        }
+        for header, expected in cases.items():
+            with self.subTest(header=header):
+                self.assertEqual(parse_range(header, 1000), expected)
+
+    def test_nothing_to_serve_from_an_empty_file(self):
+        self.assertIs(parse_range('bytes=-100', 0), False)
+        self.assertIs(parse_range('bytes=0-', 0), False)
+
+    def test_if_range_matches(self):
+        etag, last_modified = '"5f-3e8"', 1_700_000_000
+        cases = {
+            None: True,
+            etag: True,
+            '"other"': False,
+            f'W/{etag}': False,
+            http_date(last_modified): True,
+            http_date(last_modified + 1): False,
+            'not a date': False,
+        }
+        factory = RequestFactory()
+        for if_range, expected in cases.items():
+            with self.subTest(if_range=if_range):
+                headers = {} if if_range is None else {'HTTP_IF_RANGE': if_range}
+                request = factory.get('/media/news/test.jpg', **headers)
+                self.assertIs(if_range_matches(request, etag, last_modified), expected)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, METRICS_REDIS_URL='', MEDIA_SERVE_MODE='django')
+class ServeMediaTests(TestCase):
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        # MEDIA_ROOT is a subdirectory so there is a file just outside it.
+        media_root = os.path.join(tmp.name, 'media')
+        os.makedirs(os.path.join(media_root, 'news'))
+        with open(os.path.join(media_root, 'news', 'photo.jpg'), 'wb') as file:
+            file.write(self.content)
+        with open(os.path.join(tmp.name, 'secret.txt'), 'wb') as file:
+            file.write(b'secret')
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_full_file(self):
+        response = self.client.get('/media/news/photo.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('ETag', response)
+        self.assertIn('public', response['Cache-Control'])
+
+    def test_byte_range(self):
+        response = self.client.get('/media/news/photo.jpg', HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+
+        response = self.client.get('/media/news/photo.jpg', HTTP_RANGE='bytes=-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[-4:])
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get('/media/news/photo.jpg', HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.content)}')
+
+    def test_stale_if_range_sends_the_whole_file(self):
+        response = self.client.get('/media/news/photo.jpg', HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_matching_etag(self):
+        etag = self.client.get('/media/news/photo.jpg')['ETag']
+        response = self.client.get('/media/news/photo.jpg', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+    @override_settings(MEDIA_SERVE_MODE='x-accel', MEDIA_ACCEL_REDIRECT_PREFIX='/protected-media/')
+    def test_x_accel_redirect(self):
+        response = self.client.get('/media/news/photo.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/news/photo.jpg')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response.content, b'')
+
+    def test_missing_files_traversal_and_directories(self):
+        for path in ('news/missing.jpg', '../secret.txt', 'news/../../secret.txt', 'news', 'news/', ''):
+            with self.subTest(path=path):
+                self.assertEqual(self.client.get('/media/' + path).status_code, 404)
+
+    def test_only_safe_methods(self):
+        self.assertEqual(self.client.post('/media/news/photo.jpg').status_code, 405)
+
+
+@override_settings(EMAIL_BATCH_RATE_LIMIT=0, EMAIL_BATCH_CLAIM_TIMEOUT=60)
+class ActivationEmailTests(TestCase):
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(f'user{i}@example.com', 'password', name=f'Читатель {i}', is_active=False)
+            for i in range(2)
+        ]
+
+    def test_claimed_users_are_left_to_their_flush(self):
+        claimed, _ = claim_activation_emails()
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(claim_activation_emails()[0], [])
+        with mock.patch('app.task.timezone.now', return_value=timezone.now() + timedelta(seconds=61)):
+            self.assertEqual(len(claim_activation_emails()[0]), 2)
+
+    def test_results_are_recorded_after_sending(self):
+        with mock.patch('app.task.send_with_retry', side_effect=[True, False]):
+            self.assertEqual(flush_activation_emails(), 1)
+        sent, failed = User.objects.order_by('date_joined')
+        self.assertIsNotNone(sent.activation_email_sent_at)
+        self.assertEqual((failed.activation_email_sent_at, failed.activation_email_attempts), (None, 1))
+        self.assertFalse(User.objects.filter(activation_email_claimed_at__isnull=False).exists())
+
+    def test_unsent_users_are_released_when_the_batch_fails(self):
+        with mock.patch('app.task.get_connection', side_effect=OSError), self.assertRaises(OSError):
+            flush_activation_emails()
+        self.assertEqual(len(claim_activation_emails()[0]), 2)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES, ASYNC_VIEWS=False, VIEW_COUNTING=False, METRICS_ENABLED=True, METRICS_REDIS_URL='',
+    SLOW_QUERY_THRESHOLD=0, SLOW_QUERY_EXPLAIN_RATE=1,
+)
+class SlowQueryLogTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        News.objects.create(title='Новость', news_text='Текст новости')
+        querylog._explained.clear()
+
+    def entries(self, logs):
+        return [json.loads(record.getMessage()) for record in logs.records]
+
+    def test_slow_queries_are_logged_with_their_view(self):
+        with self.assertLogs('app.slow_queries', 'WARNING') as logs:
+            self.client.get(reverse('main'))
+        entries = [entry for entry in self.entries(logs) if 'app_news' in entry['sql']]
+        self.assertTrue(entries)
+        entry = entries[0]
+        self.assertEqual(entry['view'], 'main')
+        self.assertEqual(entry['database'], 'default')
+        self.assertEqual(entry['fingerprint'], querylog.fingerprint_id(entry['sql']))
+        self.assertRegex(entry['call_site'], r'app/\S+\.py:\d+ in \w+')
+        # No EXPLAIN on SQLite.
+        self.assertIsNone(entry['plan'])
+
+    def test_plan_is_sampled_once_per_fingerprint(self):
+        postgres = mock.Mock(vendor='postgresql', alias='default')
+        execute = mock.Mock(return_value=None)
+        context = {'connection': postgres}
+        with mock.patch('app.querylog.explain', return_value='Seq Scan on app_news') as explain, \
+                self.assertLogs('app.slow_queries', 'WARNING') as logs:
+            for pk in (1, 2):
+                querylog.log_slow_queries(execute, f'SELECT * FROM app_news WHERE id = {pk}', None, False, context)
+            querylog.log_slow_queries(execute, 'UPDATE app_news SET title = %s', ['x'], False, context)
+        first, second, update = self.entries(logs)
+        self.assertEqual(first['plan'], 'Seq Scan on app_news')
+        self.assertEqual(first['fingerprint'], second['fingerprint'])
+        self.assertIsNone(second['plan'])
+        self.assertIsNone(update['plan'])
+        self.assertIsNone(first['view'])
+        explain.assert_called_once_with(postgres, 'SELECT * FROM app_news WHERE id = 1', None)
+
+    @override_settings(SLOW_QUERY_THRESHOLD=60)
+    def test_fast_queries_are_not_logged(self):
+        with self.assertNoLogs('app.slow_queries'):
+            self.client.get(reverse('main'))
+
+    def test_summary(self):
+        now = timezone.now()
+        rows = [
+            ('a', 0.5, 'main', 'app/views.py:10 in get', "SELECT * FROM app_news WHERE id = 1", None, now),
+            ('a', 1.5, 'main', 'app/views.py:10 in get', "SELECT * FROM app_news WHERE id = 2", 'Seq Scan', now),
+            ('b', 0.3, None, 'app/task.py:5 in flush', "UPDATE app_news SET views_count = 3", None, now),
+            ('c', 9.0, 'detail_news', '?', "SELECT 1", None, now - timedelta(days=2)),
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.log', delete=False, encoding='utf-8') as log:
+            self.addCleanup(os.remove, log.name)
+            for key, duration, view, site, sql, plan, at in rows:
+                entry = {
+                    'time': at.isoformat(), 'fingerprint': key, 'duration': duration, 'view': view,
+                    'call_site': site, 'database': 'default', 'sql': sql, 'plan': plan,
+                }
+                log.write(json.dumps(entry) + '\n')
+            log.write('not json\n')
+
+        out = StringIO()
+        call_command('slow_queries', log=log.name, hours=24, plans=True, stdout=out, no_color=True)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'a  2 times, total 2.00 s, mean 1000 ms, p95 1500 ms, max 1500 ms')
+        self.assertIn('  view: main (2)', lines)
+        self.assertIn('  from: app/views.py:10 in get (2)', lines)
+        self.assertIn('  SELECT * FROM app_news WHERE id = ?', lines)
+        self.assertIn('  Seq Scan', lines)
+        self.assertIn('b  1 times, total 0.30 s, mean 300 ms, p95 300 ms, max 300 ms', lines)
+        self.assertIn('  view: - (1)', lines)
+        self.assertNotIn('c  ', out.getvalue())
+
+        out = StringIO()
+        call_command('slow_queries', log=log.name, sort='max', limit=1, stdout=out, no_color=True)
+        self.assertTrue(out.getvalue().startswith('c  1 times'))
+        self.assertNotIn('a  ', out.getvalue())
+
+    def test_summary_without_a_log(self):
+        with self.assertRaises(CommandError):
+            call_command('slow_queries', log='/nonexistent/slow_queries.log', stdout=StringIO())
+
+
+class PercentileTests(SimpleTestCase):
+    def test_nearest_rank(self):
+        values = [float(value) for value in range(1, 11)]
+        cases = {0: 1.0, 10: 1.0, 11: 2.0, 50: 5.0, 90: 9.0, 95: 10.0, 99: 10.0, 100: 10.0}
+        for percent, expected in cases.items():
+            with self.subTest(percent=percent):
+                self.assertEqual(percentile(values, percent), expected)
+
+    def test_small_samples(self):
+        self.assertEqual(percentile([], 50), 0.0)
+        self.assertEqual(percentile([0.25], 99), 0.25)
+        self.assertEqual(percentile([0.1, 0.2], 50), 0.1)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    STORAGES={**settings.STORAGES, 'default': {'BACKEND': 'django.core.files.storage.InMemoryStorage'}},
+)
+class SeedNewsTests(TestCase):
+    def seed(self):
+        out = StringIO()
+        # bulk_create skips the comment signals, so reconcile_comment_counts fixes every commented news.
+        with self.assertLogs('app.task', 'WARNING'):
+            call_command(
+                'seed_news', categories=3, news=40, users=5, comments=60, images=1, batch_size=7, stdout=out,
+                no_color=True,
+            )
+        return out.getvalue()
+
+    def test_row_counts_and_category_spread(self):
+        self.assertIn('Created 3 categories, 40 news, 5 users and 60 comments.', self.seed())
+        self.assertEqual(Category.objects.count(), 3)
+        self.assertEqual(News.objects.count(), 40)
+        self.assertEqual(User.objects.filter(email__startswith='seed-').count(), 5)
+        self.assertEqual(Comment.objects.count(), 60)
+        # Every category gets news, and some news have none.
+        spread = Counter(News.objects.values_list('category_id', flat=True))
+        self.assertEqual(set(spread), {*Category.objects.values_list('pk', flat=True), None})
+        self.assertLess(max(spread.values()), 40 // 2)
+        self.assertFalse(News.objects.filter(excerpt='').exists())
+        self.assertEqual(sum(News.objects.values_list('comments_count', flat=True)), 60)
+
+    def test_seeding_again_skips_existing_users(self):
+        self.seed()
+        self.assertIn('Created 3 categories, 40 news, 0 users and 60 comments.', self.seed())
+        self.assertEqual(User.objects.filter(email__startswith='seed-').count(), 5)
+        self.assertEqual(News.objects.count(), 80)
+
+
+class StackSamplerTests(TestCase):
+    def test_watchers_of_one_thread_keep_their_own_samples(self):
+        sampler = StackSampler(0.001)
+        thread_id = threading.get_ident()
+        first = sampler.watch(thread_id)
+        time.sleep(0.05)
+        second = sampler.watch(thread_id)
+        sampler.unwatch(thread_id, first)
+        total = sum(first.values())
+        time.sleep(0.05)
+        sampler.unwatch(thread_id, second)
+        self.assertTrue(total and second)
+        # The first watcher's samples are final once it stops watching.
+        self.assertEqual(sum(first.values()), total)
+        self.assertFalse(sampler.watched)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CommentCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.reader = User.objects.create_user('reader@example.com', 'password', name='Читатель')
+        self.writer = User.objects.create_user('writer@example.com', 'password', name='Писатель')
+        self.news = [News.objects.create(title=f'Новость {i}', news_text='Текст новости') for i in range(2)]
+
+    def comment(self, author, news):
+        return Comment.objects.create(author=author, comment_text='Комментарий', comment_to_news=news)
+
+    def counts(self):
+        return list(News.objects.order_by('pk').values_list('comments_count', flat=True))
+
+    @override_settings(COMMENT_COUNT_BUMP_DELAY=60)
+    def test_comments_bump_the_index_once_per_delay(self):
+        etag, _ = news_list_validators(None, AnonymousUser())
+        with mock.patch('app.signals.invalidate_news_list') as invalidate_list, \
+                mock.patch('app.task.bump_comment_counts') as bump, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.comment(self.reader, self.news[0])
+            self.comment(self.writer, self.news[1]).delete()
+        invalidate_list.assert_not_called()
+        bump.apply_async.assert_called_once_with(countdown=60)
+        self.assertEqual(self.counts(), [1, 0])
+        # The delayed task.
+        bump_comment_count_version()
+        self.assertNotEqual(news_list_validators(None, AnonymousUser())[0], etag)
+
+    def test_deleting_a_user_uncounts_their_comments_at_once(self):
+        for news in (self.news[0], self.news[0], self.news[1]):
+            self.comment(self.reader, news)
+        self.comment(self.writer, self.news[0])
+        with CaptureQueriesContext(connection) as queries:
+            self.reader.delete()
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "app_news"')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(self.counts(), [1, 0])
+
+    def test_deleting_a_news_does_not_uncount_each_comment(self):
+        for _ in range(3):
+            self.comment(self.reader, self.news[0])
+        with CaptureQueriesContext(connection) as queries:
+            self.news[0].delete()
+        self.assertFalse([query for query in queries if query['sql'].startswith('UPDATE "app_news"')])
+
+
+@override_settings(CACHES=LOCMEM_CACHES, DATABASE_REPLICAS=['replica'], VIEW_COUNTING=False, METRICS_REDIS_URL='')
+class ReplicaRoutingTests(TransactionTestCase):
+    """The replica mirrors the test database, so only the routing is observed."""
+
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        # Transactions commit here, which would queue image variants.
+        for target in ('app.signals.make_image_variants', 'app.task.rebump_versions', 'app.task.bump_comment_counts'):
+            patcher = mock.patch(target)
+            self.addCleanup(patcher.stop)
+            setattr(self, target.rsplit('.', 1)[1], patcher.start())
+        cache.clear()
+        self.user = User.objects.create_user('reader@example.com', 'password', name='Читатель')
+        self.news = News.objects.create(title='Новость', news_text='Текст новости', news_image='news/test.jpg')
+        self.url = reverse('detail_news', kwargs={'pk': self.news.pk})
+
+    def databases_used(self, method, *args):
+        used = []
+
+        def record(alias):
+            def wrapper(execute, sql, params, many, context):
+                used.append(alias)
+                return execute(sql, params, many, context)
+            return wrapper
+
+        with connections['default'].execute_wrapper(record('default')):
+            with connections['replica'].execute_wrapper(record('replica')):
+                response = method(*args)
+        return response, set(used)
+
+    def test_reads_go_to_the_replica(self):
+        response, used = self.databases_used(self.client.get, self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(used, {'replica'})
+
+    def test_writer_sticks_to_the_primary(self):
+        self.client.force_login(self.user)
+        response, used = self.databases_used(self.client.post, self.url, {'comment_text': 'Комментарий'})
+        self.assertEqual(used, {'default'})
+        self.assertIn('use_primary', response.cookies)
+        response, used = self.databases_used(self.client.get, self.url)
+        self.assertEqual(used, {'default'})
+        self.assertContains(response, 'Комментарий')
+
+    def test_cached_pages_are_read_from_the_primary(self):
+        # Stored under the current versions, so a lagging replica must not
+        # provide them.
+        categories.invalidate()
+        response, used = self.databases_used(self.client.get, reverse('main'))
+        self.assertContains(response, 'Новость')
+        self.assertEqual(used, {'default'})
+
+    def test_bumps_are_repeated_once_the_replicas_caught_up(self):
+        self.news.title = 'Другая новость'
+        self.news.save()
+        self.rebump_versions.apply_async.assert_any_call(
+            (f'news:{self.news.pk}:version',), countdown=settings.DATABASE_REPLICA_STICKY_SECONDS,
+        )
+
+
+class FakeRedis:
+    """The few Redis commands app.popularity and app.metrics use, on dicts."""
+
+    def __init__(self):
+        self.data = {}
+        self.locked = set()
+
+    def lock(self, name, timeout=None):
+        redis = self
+
+        class Lock:
+            def acquire(self, blocking=True):
+                if name in redis.locked:
+                    return False
+                redis.locked.add(name)
+                return True
+
+            def release(self):
+                redis.locked.discard(name)
+
+        return Lock()
+
+    def exists(self, key):
+        return key in self.data
+
+    def rename(self, key, new_key):
+        self.data[new_key] = self.data.pop(key)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def hgetall(self, key):
+        return {field.encode(): str(value).encode() for field, value in self.data.get(key, {}).items()}
+
+    def zrevrange(self, key, start, end, withscores=False):
+        ranking = sorted(self.data.get(key, {}).items(), key=lambda item: (-item[1], item[0]))
+        return [(member.encode(), score) for member, score in ranking[start:end + 1]]
+
+    def zunionstore(self, key, keys):
+        union = defaultdict(float)
+        for source in keys:
+            for member, score in self.data.get(source, {}).items():
+                union[member] += score
+        self.data[key] = dict(union)
+
+    def hincrbyfloat(self, key, field, amount):
+        values = self.data.setdefault(key, {})
+        values[field] = values.get(field, 0) + amount
+
+    def hset(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+
+    def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(members)
+
+    def smembers(self, key):
+        return {member.encode() for member in self.data.get(key, set())}
+
+    def srem(self, key, *members):
+        self.data.get(key, set()).difference_update(members)
+
+    def expire(self, key, seconds):
+        pass
+
+    def pipeline(self, transaction=True):
+        redis = self
+
+        class Pipeline:
+            def __init__(self):
+                self.commands = []
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                pass
+
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+            def execute(self):
+                return [getattr(redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+        return Pipeline()
+
+
+@override_settings(CACHES=LOCMEM_CACHES, MOST_READ_SIZE=2, METRICS_REDIS_URL='')
+class ViewCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.redis = FakeRedis()
+        patcher = mock.patch('app.popularity.get_client', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.news = News.objects.bulk_create(
+            News(title=f'Новость {i}', news_text='Текст новости', news_image='news/test.jpg') for i in range(3)
+        )
+
+    def rank(self, days_ago, **scores):
+        day = timezone.localdate() - timedelta(days=days_ago)
+        self.redis.data[popularity._rank_key(day)] = {str(self.news[int(i)].pk): score for i, score in scores.items()}
+
+    def test_flush_adds_pending_views_in_batches(self):
+        first, second, third = (news.pk for news in self.news)
+        self.redis.data[popularity.PENDING_KEY] = {
+            str(first): 5, f'{first}:u': 2, str(second): 1, f'{second}:u': 1, str(third): 3,
+        }
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(flush_view_counts(batch_size=2), 3)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE')]), 2)
+        self.assertEqual(
+            list(News.objects.order_by('pk').values_list('views_count', 'unique_views')), [(5, 2), (1, 1), (3, 0)],
+        )
+        self.assertEqual(self.redis.data, {})
+        self.assertEqual(flush_view_counts(), 0)
+
+    def test_failed_flush_is_retried(self):
+        pk = self.news[0].pk
+        self.redis.data[popularity.PENDING_KEY] = {str(pk): 4}
+        with mock.patch('app.task.News.objects.filter', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                flush_view_counts()
+        self.redis.data[popularity.PENDING_KEY] = {str(pk): 1}
+        flush_view_counts()
+        # The counts left under FLUSHING_KEY go first, the newer ones next time.
+        self.assertEqual(News.objects.get(pk=pk).views_count, 4)
+        flush_view_counts()
+        self.assertEqual(News.objects.get(pk=pk).views_count, 5)
+
+    def test_concurrent_flush_waits_for_the_lock(self):
+        self.redis.data[popularity.PENDING_KEY] = {str(self.news[0].pk): 4}
+        self.redis.locked.add(popularity.FLUSH_LOCK_KEY)
+        self.assertEqual(flush_view_counts(), 0)
+        self.assertIn(popularity.PENDING_KEY, self.redis.data)
+
+    def test_most_read_today_and_this_week(self):
+        self.rank(0, **{'0': 1, '1': 3})
+        self.rank(3, **{'0': 5, '2': 1})
+        self.rank(8, **{'2': 100})
+        with self.assertNumQueries(1):
+            most_read = popularity.build_most_read()
+        titles = {period: [item['title'] for item in most_read[period]] for period in ('today', 'week')}
+        self.assertEqual(titles, {'today': ['Новость 1', 'Новость 0'], 'week': ['Новость 0', 'Новость 1']})
+        self.assertEqual(most_read['week'][0]['readers'], 6)
+
+    def test_version_changes_with_the_news_shown(self):
+        self.rank(0, **{'0': 1, '1': 3})
+        version = popularity.build_most_read()['version']
+        self.rank(0, **{'0': 2, '1': 3})
+        self.assertEqual(popularity.build_most_read()['version'], version)
+        self.rank(0, **{'0': 4, '1': 3})
+        self.assertNotEqual(popularity.build_most_read()['version'], version)
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES, ASYNC_VIEWS=False, VIEW_COUNTING=False, METRICS_ENABLED=True, METRICS_REDIS_URL='',
+)
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        News.objects.create(title='Новость', news_text='Текст новости')
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse('main'))
+        self.assertRegex(
+            response['Server-Timing'],
+            r'^db;dur=\d+\.\d;desc="[1-9]\d* queries", tpl;dur=\d+\.\d, '
+            r'cache;desc="\d+ hits, \d+ misses", total;dur=\d+\.\d$',
+        )
+
+    def test_requests_are_observed_under_the_view_name(self):
+        def count(histogram):
+            counts, _ = histogram.values.get(('main',), ([0], 0))
+            return sum(counts)
+
+        histograms = [metrics.REQUEST_DURATION, metrics.DB_DURATION, metrics.DB_QUERIES, metrics.TEMPLATE_DURATION]
+        before = [count(histogram) for histogram in histograms]
+        requests = metrics.REQUESTS.values.get(('main', 'GET', 200), 0)
+        self.client.get(reverse('main'))
+        self.assertEqual([count(histogram) for histogram in histograms], [n + 1 for n in before])
+        self.assertEqual(metrics.REQUESTS.values[('main', 'GET', 200)], requests + 1)
+        self.assertIn('news_http_request_duration_seconds_count{view="main"}', render_metrics())
+
+    @override_settings(DEBUG=False, METRICS_TOKEN='secret')
+    def test_metrics_need_the_token_outside_debug(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '# TYPE news_http_requests_total counter')
+
+    @override_settings(DEBUG=False, METRICS_TOKEN='')
+    def test_metrics_are_hidden_without_a_token(self):
+        self.assertEqual(self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+
+    @override_settings(DEBUG=True, METRICS_TOKEN='')
+    def test_metrics_are_open_in_debug(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+
+class SharedMetricsTests(TestCase):
+    """Metrics of several processes added up by SharedStore, against a FakeRedis."""
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.requests = MetricCounter('requests_total', 'Requests.', ('view',))
+        self.duration = Histogram('duration_seconds', 'Duration.', ('view',), buckets=(0.1, 1))
+        self.pool_size = 2
+        self.pool = Collected('pool_size', 'Pool size.', 'gauge', ('database',), lambda: [(('default',), self.pool_size)])
+        self.registry = [self.requests, self.duration, self.pool]
+
+    def store(self, process):
+        store = SharedStore('redis://localhost', 5)
+        store.client = self.redis
+        # Started already, so no flushing thread.
+        store.pid = os.getpid()
+        store.process = process
+        return store
+
+    def test_processes_are_added_up(self):
+        for process, duration in (('web-1', 0.05), ('web-2', 0.5)):
+            self.requests.inc('main')
+            self.duration.observe(duration, 'main')
+            self.store(process).flush(self.registry)
+        values = self.store('web-1').load(self.registry)
+        self.assertEqual(values['requests_total'], {('main',): 2})
+        self.assertEqual(values['duration_seconds'], {('main',): [[1, 1, 0], 0.55]})
+        self.assertEqual(values['pool_size'], {('default',): 4})
+        self.assertIn('duration_seconds_bucket{view="main",le="1"} 2', render_metrics(self.registry, values))
+
+    def test_gauges_of_gone_processes_are_dropped(self):
+        self.store('web-1').flush(self.registry)
+        self.store('web-2').flush(self.registry)
+        # Expired.
+        self.redis.delete('metrics:process:web-2')
+        values = self.store('web-1').load(self.registry)
+        self.assertEqual(values['pool_size'], {('default',): 2})
+        self.assertEqual(self.redis.data[PROCESSES_KEY], {'web-1'})
+
+    def test_values_are_kept_when_redis_fails(self):
+        self.requests.inc('main')
+        store = self.store('web-1')
+        with mock.patch.object(self.redis, 'pipeline', side_effect=redis.ConnectionError):
+            with self.assertRaises(redis.ConnectionError):
+                store.flush(self.registry)
+        store.flush(self.registry)
+        self.assertEqual(store.load(self.registry)['requests_total'], {('main',): 1})
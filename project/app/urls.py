@@ -1,11 +1,23 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+if settings.ASYNC_VIEWS:
+    news_list_view = views.AsyncNewsListView.as_view()
+    news_detail_view = views.AsyncNewsDetailView.as_view()
+    news_comments_view = views.AsyncNewsCommentsView.as_view()
+else:
+    news_list_view = views.NewsListView.as_view()
+    news_detail_view = views.NewsDetailView.as_view()
+    news_comments_view = views.NewsCommentsView.as_view()
+
 urlpatterns = [
     path('main/delete/<int:pk>/<int:del_comment>', views.CommentDeleteView.as_view(), name='comment_delete'),
     path('main/<int:pk>/<int:comment>', views.CommentUpdateView.as_view(), name='comment_change'),
-    path('main/<int:pk>', views.NewsDetailView.as_view(), name='detail_news'),
-    path('main/', views.NewsListView.as_view(), name='main'),
+    path('main/<int:pk>', news_detail_view, name='detail_news'),
+    path('main/<int:pk>/comments', news_comments_view, name='news_comments'),
+    path('main/', news_list_view, name='main'),
+    path('search/', views.NewsSearchView.as_view(), name='search'),
     path('login/', views.UserLoginView.as_view(), name='login'),
     path('register/', views.RegistrationView.as_view(), name='registration'),
     path('account_sent/', views.Account_activation_sent.as_view(), name='account_sent'),
@@ -8,54 +8,299 @@ from django.contrib.auth.views import LoginView, PasswordChangeView, PasswordCha
 from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
 from .forms import *
-from django.utils.http import urlsafe_base64_decode
+from django.utils.http import http_date, urlsafe_base64_decode, urlencode
 from django.contrib.auth import login
-from django.http import HttpResponseBadRequest
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
+from django.contrib.auth.views import redirect_to_login
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
 from django.contrib.auth.tokens import default_token_generator
 from django.contrib.sites.models import Site
 from .task import send_email
+from .pagination import CursorPage, KeysetPaginator
+from .cache import (
+    aget_categories, anews_list_key, anews_list_validators, anews_validators, categories,
+    get_categories, news_list_key, news_list_validators, news_validators,
+)
+from .popularity import aget_most_read, get_most_read, record_view
+from .routers import primary
+from .images import aimage_variants, image_variants
+from .search import search_news
+from django.core.cache import cache
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.contrib import admin
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse
+from .profiling import CPROFILE, get_profile, list_profiles, profile_filename, profile_summary
 
 ############## News, Comment Views ##############
 
 
-class NewsListView(View):
+class ConditionalGetMixin:
+    """
+    Answer a GET whose ETag/Last-Modified still match with 304 before the
+    page's queries run. Validators come from app.cache versions, so checking
+    them costs cache lookups only.
+    """
+
+    def not_modified(self, request, validators):
+        etag, last_modified = validators
+        return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+    def add_validators(self, response, validators):
+        etag, last_modified = validators
+        if response.status_code in (200, 304):
+            response.headers.setdefault('ETag', etag)
+            response.headers.setdefault('Last-Modified', http_date(last_modified))
+        return response
+
+
+class NewsListView(ConditionalGetMixin, View):
     template_name = 'app/index.html'
+    list_template_name = 'app/news_list.html'
     context_object_name = 'news'
-    
-    def get(self, request):
-        context = {'news': News.objects.all(), 'categories': Category.objects.all()}
+    paginate_by = 20
+
+    def get_queryset(self, category_id=None):
+        # The cards show the stored excerpt, never the full text.
+        queryset = News.objects.select_related('category').defer('news_text')
+        if category_id is not None:
+            queryset = queryset.filter(category_id=category_id)
+        return queryset
+
+    def get_category_id(self, value):
+        try:
+            category_id = int(value)
+        except (TypeError, ValueError):
+            return None
+        if categories.get(category_id) is not None:
+            return category_id
+        return None
+
+    def get_paginator(self, category_id=None):
+        return KeysetPaginator(self.get_queryset(category_id), self.paginate_by, 'news_posted_at')
+
+    def get_list_url(self, category_id=None, cursor=None):
+        """Canonical URL of a listing page: category first, then cursor."""
+        params = {}
+        if category_id is not None:
+            params['category'] = category_id
+        if cursor:
+            params['cursor'] = cursor
+        url = reverse('main')
+        return f'{url}?{urlencode(params)}' if params else url
+
+    def render_news_list(self, category_id=None, cursor=None):
+        page = self.get_paginator(category_id).get_page(cursor)
+        next_url = self.get_list_url(category_id, page.next_cursor) if page.has_next() else None
+        return render_to_string(self.list_template_name, {
+            self.context_object_name: page, 'next_url': next_url,
+            'image_variants': image_variants(news.news_image for news in page),
+        })
+
+    def render_page(self, request, category_id=None, cursor=None, most_read=None):
+        # The article list is the same for every reader, so it is cached per
+        # listing and cursor; the header around it is rendered per request.
+        key = news_list_key(category_id, cursor)
+        news_list = cache.get(key)
+        if news_list is None:
+            with primary():
+                news_list = self.render_news_list(category_id, cursor)
+            cache.set(key, news_list, settings.NEWS_LIST_CACHE_TIMEOUT)
+        context = {
+            'news_list': news_list, 'categories': get_categories(), 'category_id': category_id, 'most_read': most_read,
+        }
         return render(request, self.template_name, context)
 
+    def get(self, request):
+        category_id = self.get_category_id(request.GET.get('category'))
+        cursor = request.GET.get('cursor')
+        if cursor and not self.get_paginator().is_valid_cursor(cursor):
+            cursor = None
+        url = self.get_list_url(category_id, cursor)
+        if request.get_full_path() != url:
+            return redirect(url, permanent=True)
+
+        most_read = get_most_read()
+        validators = news_list_validators(category_id, request.user, most_read['version'])
+        response = self.not_modified(request, validators) or self.render_page(request, category_id, cursor, most_read)
+        self.add_validators(response, validators)
+        return self.patch_cache_headers(response, request.user)
+
+    def patch_cache_headers(self, response, user):
+        # Only the header differs between readers, and only by login state, so
+        # anonymous pages can be shared by the reverse proxy.
+        if user.is_authenticated:
+            patch_cache_control(response, private=True, max_age=0)
+        else:
+            patch_cache_control(response, public=True, max_age=settings.NEWS_LIST_MAX_AGE)
+        patch_vary_headers(response, ('Cookie',))
+        return response
+
     def post(self, request):
+        # Filtering used to be a POSTed form; keep old forms working by
+        # sending them to the equivalent GET URL.
         if not request.POST.get('filtering') or request.POST.get('cancel'):
-            context = {'news': News.objects.all(), 'categories': Category.objects.all()}
-            return render(request, self.template_name, context)
-        else:
-            try:
-                category = Category.objects.get(pk=int(request.POST.get('filtering')))
-                context={'news': News.objects.filter(category_id=category.pk), 'categories': Category.objects.all()}
-                return render(request, self.template_name, context)
-            except Category.DoesNotExist:
-                context={'news': News.objects.all(), 'categories': Category.objects.all()}
-                return render(request, self.template_name, context)
+            return redirect(self.get_list_url())
+        return redirect(self.get_list_url(self.get_category_id(request.POST.get('filtering'))))
             
 
-class NewsDetailView(UpdateView):
-    model = News
+class NewsSearchView(View):
+    template_name = 'app/search.html'
+
+    def get(self, request):
+        query = request.GET.get('q', '').strip()
+        results = search_news(query)
+        context = {
+            'query': query, 'results': results, 'image_variants': image_variants(news.news_image for news in results),
+        }
+        return render(request, self.template_name, context)
+
+
+class NewsDetailMixin(ConditionalGetMixin):
     template_name = 'app/detail.html'
+    comments_template_name = 'app/comment_list.html'
+    comment_template_name = 'app/comment.html'
     context_object_name = 'news'
+    comments_per_page = 50
+
+    def get_queryset(self):
+        return News.objects.select_related('category')
+
+    def get_comments(self, news_id):
+        return (
+            Comment.objects.filter(comment_to_news_id=news_id)
+            .select_related('author')
+            .only('comment_text', 'comment_posted_at', 'author__name', 'author__image')
+        )
+
+    def get_comments_paginator(self, news_id):
+        # Newest first by (comment_posted_at, id), along app_comment_news_posted_idx.
+        return KeysetPaginator(self.get_comments(news_id), self.comments_per_page, 'comment_posted_at')
+
+    def get_comments_context(self, news_id, page):
+        """
+        Context of a page of comments. ``next_url`` shows the next page under
+        the article (no JavaScript), ``next_fragment_url`` returns just the
+        comments for appending in place.
+        """
+        context = {'comments': page, 'news_id': news_id, 'next_url': None, 'next_fragment_url': None}
+        if page.has_next():
+            query = urlencode({'cursor': page.next_cursor})
+            context['next_url'] = f"{reverse('detail_news', kwargs={'pk': news_id})}?{query}#comments"
+            context['next_fragment_url'] = f"{reverse('news_comments', kwargs={'pk': news_id})}?{query}"
+        return context
+
+    def comment_images(self, page):
+        return [comment.author.image for comment in page]
+
+    def comments_json(self, page):
+        data = {'comments': [
+            {
+                'id': comment.pk,
+                'author': {
+                    'id': comment.author.pk,
+                    'name': comment.author.name,
+                    'image': comment.author.image.url if comment.author.image else None,
+                    'url': reverse('profile', kwargs={'pk': comment.author.pk}),
+                },
+                'text': comment.comment_text,
+                'posted_at': comment.comment_posted_at.isoformat(),
+            }
+            for comment in page
+        ]}
+        data['next_cursor'] = page.next_cursor
+        return data
+
+    @transaction.atomic
+    def create_comment(self, user, news_id, comment_text):
+        # With the comments_count update done by the post_save signal.
+        return Comment.objects.create(author=user, comment_text=comment_text, comment_to_news_id=news_id)
+
+
+class NewsDetailView(NewsDetailMixin, UpdateView):
+    model = News
     form_class = CommentForm
 
+    def get(self, request, *args, **kwargs):
+        validators = news_validators(kwargs['pk'], request.user)
+        response = self.not_modified(request, validators) or super().get(request, *args, **kwargs)
+        # A 304 is a reader coming back, which counts as a view too.
+        record_view(request, kwargs['pk'])
+        return self.add_validators(response, validators)
+
     def form_valid(self, form):
-        comment_text = form.cleaned_data['comment_text']
-        Comment.objects.create(author = self.request.user, comment_text = comment_text, comment_to_news = self.get_object())
-        return redirect(reverse_lazy('detail_news', kwargs={"pk": self.get_object().pk}))
+        self.create_comment(self.request.user, self.object.pk, form.cleaned_data['comment_text'])
+        return redirect(reverse_lazy('detail_news', kwargs={"pk": self.object.pk}))
 
     def get_context_data(self, **kwargs):
         context = super(NewsDetailView, self).get_context_data(**kwargs)
-        context['comments_count'] = Comment.objects.filter(comment_to_news=self.get_object().pk).count()
-        context['comments'] = Comment.objects.filter(comment_to_news=self.get_object().pk)
+        context['comments_count'] = self.object.comments_count
+        page = self.get_comments_paginator(self.object.pk).get_page(self.request.GET.get('cursor'))
+        context.update(self.get_comments_context(self.object.pk, page))
+        context['image_variants'] = image_variants([self.object.news_image, *self.comment_images(page)])
         return context
+
+
+class NewsCommentsView(NewsDetailMixin, View):
+    """
+    GET: a page of a news item's comments after ?cursor=, as an HTML
+    fragment, or as JSON with ?format=json.
+
+    POST: add a comment and answer 201 with just that comment rendered, for
+    the comment form on the news page to insert in place. Errors come back
+    as JSON: 400 with the form errors, 403 for anonymous users, 404 for a
+    missing news item.
+    """
+
+    def wants_json(self, request):
+        return request.GET.get('format') == 'json'
+
+    def render_comments(self, request, pk, page, variants=None):
+        if self.wants_json(request):
+            return JsonResponse(self.comments_json(page))
+        context = {**self.get_comments_context(pk, page), 'image_variants': variants}
+        return render(request, self.comments_template_name, context)
+
+    def render_comment(self, request, pk, comment, variants=None):
+        if self.wants_json(request):
+            return JsonResponse(self.comments_json(CursorPage([comment]))['comments'][0], status=201)
+        context = {'comment': comment, 'news_id': pk, 'image_variants': variants}
+        return render(request, self.comment_template_name, context, status=201)
+
+    def forbidden(self):
+        return JsonResponse({'errors': {'__all__': [{'message': 'Войдите, чтобы комментировать.'}]}}, status=403)
+
+    def invalid(self, form):
+        return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+
+    def add_comment(self, user, pk, comment_text):
+        # One INSERT; the news item is not loaded, its foreign key vouches
+        # for it when the transaction commits.
+        try:
+            return self.create_comment(user, pk, comment_text)
+        except IntegrityError:
+            raise Http404('Новость не найдена')
+
+    def get(self, request, pk):
+        validators = news_validators(pk, request.user)
+        response = self.not_modified(request, validators)
+        if response is None:
+            page = self.get_comments_paginator(pk).get_page(request.GET.get('cursor'))
+            variants = None if self.wants_json(request) else image_variants(self.comment_images(page))
+            response = self.render_comments(request, pk, page, variants)
+        return self.add_validators(response, validators)
+
+    def post(self, request, pk):
+        if not request.user.is_authenticated:
+            return self.forbidden()
+        form = CommentForm(request.POST)
+        if not form.is_valid():
+            return self.invalid(form)
+        comment = self.add_comment(request.user, pk, form.cleaned_data['comment_text'])
+        return self.render_comment(request, pk, comment)
     
 @method_decorator(login_required, name="dispatch")
 class CommentUpdateView(UpdateView):
@@ -73,11 +318,153 @@ class CommentDeleteView(DeleteView):
     template_name = 'app/del_comm.html'
     pk_url_kwarg = 'del_comment'
 
+    @transaction.atomic
+    def form_valid(self, form):
+        # With the comments_count update done by the post_delete signal.
+        return super().form_valid(form)
+
     def get_success_url(self):
         return reverse('detail_news', kwargs={"pk": self.kwargs['pk']})
     
 
 
+# ========================================
+
+########## Async News, Comment Views ##########
+
+# The same read paths and comment submission on the async ORM, for running
+# under an ASGI server (ASYNC_VIEWS = True). Nothing here may touch the
+# database synchronously, including lazily from templates, so the user is
+# resolved with request.auser() before rendering.
+
+
+class AsyncNewsListView(NewsListView):
+
+    async def aget_category_id(self, value):
+        try:
+            category_id = int(value)
+        except (TypeError, ValueError):
+            return None
+        if await categories.aget(category_id) is not None:
+            return category_id
+        return None
+
+    async def arender_news_list(self, category_id=None, cursor=None):
+        page = await self.get_paginator(category_id).aget_page(cursor)
+        next_url = self.get_list_url(category_id, page.next_cursor) if page.has_next() else None
+        return render_to_string(self.list_template_name, {
+            self.context_object_name: page, 'next_url': next_url,
+            'image_variants': await aimage_variants(news.news_image for news in page),
+        })
+
+    async def arender_page(self, request, category_id=None, cursor=None, most_read=None):
+        key = await anews_list_key(category_id, cursor)
+        news_list = await cache.aget(key)
+        if news_list is None:
+            with primary():
+                news_list = await self.arender_news_list(category_id, cursor)
+            await cache.aset(key, news_list, settings.NEWS_LIST_CACHE_TIMEOUT)
+        context = {
+            'news_list': news_list, 'categories': await aget_categories(), 'category_id': category_id,
+            'most_read': most_read,
+        }
+        return render(request, self.template_name, context)
+
+    async def get(self, request):
+        request.user = await request.auser()
+        category_id = await self.aget_category_id(request.GET.get('category'))
+        cursor = request.GET.get('cursor')
+        if cursor and not self.get_paginator().is_valid_cursor(cursor):
+            cursor = None
+        url = self.get_list_url(category_id, cursor)
+        if request.get_full_path() != url:
+            return redirect(url, permanent=True)
+
+        most_read = await aget_most_read()
+        validators = await anews_list_validators(category_id, request.user, most_read['version'])
+        response = (
+            self.not_modified(request, validators)
+            or await self.arender_page(request, category_id, cursor, most_read)
+        )
+        self.add_validators(response, validators)
+        return self.patch_cache_headers(response, request.user)
+
+    async def post(self, request):
+        if not request.POST.get('filtering') or request.POST.get('cancel'):
+            return redirect(self.get_list_url())
+        return redirect(self.get_list_url(await self.aget_category_id(request.POST.get('filtering'))))
+
+
+class AsyncNewsDetailView(NewsDetailMixin, View):
+
+    async def aget_object(self, pk):
+        try:
+            return await self.get_queryset().aget(pk=pk)
+        except News.DoesNotExist:
+            raise Http404('Новость не найдена')
+
+    async def render_detail(self, request, form):
+        page = await self.get_comments_paginator(self.object.pk).aget_page(request.GET.get('cursor'))
+        context = {
+            self.context_object_name: self.object,
+            'form': form,
+            'comments_count': self.object.comments_count,
+            **self.get_comments_context(self.object.pk, page),
+            # Looked up here, or each responsive_image would block the loop on it.
+            'image_variants': await aimage_variants([self.object.news_image, *self.comment_images(page)]),
+        }
+        return render(request, self.template_name, context)
+
+    async def get(self, request, pk):
+        request.user = await request.auser()
+        validators = await anews_validators(pk, request.user)
+        response = self.not_modified(request, validators)
+        if response is None:
+            self.object = await self.aget_object(pk)
+            response = await self.render_detail(request, CommentForm())
+        # One Redis round trip, kept off the thread-sensitive executor that
+        # serializes the ORM calls of every async view.
+        await sync_to_async(record_view, thread_sensitive=False)(request, pk)
+        return self.add_validators(response, validators)
+
+    async def post(self, request, pk):
+        request.user = await request.auser()
+        if not request.user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        form = CommentForm(request.POST)
+        if not await sync_to_async(form.is_valid)():
+            self.object = await self.aget_object(pk)
+            return await self.render_detail(request, form)
+        if not await News.objects.filter(pk=pk).aexists():
+            raise Http404('Новость не найдена')
+        await sync_to_async(self.create_comment)(request.user, pk, form.cleaned_data['comment_text'])
+        return redirect(reverse('detail_news', kwargs={"pk": pk}))
+
+
+class AsyncNewsCommentsView(NewsCommentsView):
+
+    async def get(self, request, pk):
+        request.user = await request.auser()
+        validators = await anews_validators(pk, request.user)
+        response = self.not_modified(request, validators)
+        if response is None:
+            page = await self.get_comments_paginator(pk).aget_page(request.GET.get('cursor'))
+            variants = None if self.wants_json(request) else await aimage_variants(self.comment_images(page))
+            response = self.render_comments(request, pk, page, variants)
+        return self.add_validators(response, validators)
+
+    async def post(self, request, pk):
+        request.user = await request.auser()
+        if not request.user.is_authenticated:
+            return self.forbidden()
+        form = CommentForm(request.POST)
+        if not await sync_to_async(form.is_valid)():
+            return self.invalid(form)
+        comment = await sync_to_async(self.add_comment)(request.user, pk, form.cleaned_data['comment_text'])
+        variants = None if self.wants_json(request) else await aimage_variants([comment.author.image])
+        return self.render_comment(request, pk, comment, variants)
+
+
 # ========================================
 
 ############### User Views ###############
@@ -98,7 +485,10 @@ class RegistrationView(CreateView):
         user.is_active = False
         user.save()
 
-        send_email.delay(user.pk)
+        # In batching mode the pending user is picked up by
+        # flush_activation_emails on the next celery-beat tick.
+        if not settings.EMAIL_BATCHING:
+            send_email.delay(user.pk)
 
         return redirect('account_sent')
 
@@ -174,4 +564,60 @@ class UserChangePasswordDone(PasswordChangeDoneView):
 # ========================================
 
 
+############## Request Profile Views ##############
+
+
+class RequestProfileMixin:
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(admin.site.each_context(self.request))
+        return context
+
+    def get_profile(self):
+        profile = get_profile(self.kwargs['profile_id'])
+        if profile is None:
+            raise Http404('Профиль не найден')
+        return profile
+
+
+@method_decorator(staff_member_required, name="dispatch")
+class RequestProfileListView(RequestProfileMixin, TemplateView):
+    template_name = 'app/admin/request_profiles.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(title='Профили запросов', profiles=list_profiles())
+        return context
+
+
+@method_decorator(staff_member_required, name="dispatch")
+class RequestProfileDetailView(RequestProfileMixin, TemplateView):
+    template_name = 'app/admin/request_profile.html'
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        profile = self.get_profile()
+        context.update(
+            title=f"{profile['method']} {profile['url']}",
+            profile=profile,
+            summary=profile_summary(profile),
+            query_time=sum(duration for _, duration in profile['queries']),
+        )
+        return context
+
+
+@method_decorator(staff_member_required, name="dispatch")
+class RequestProfileDownloadView(RequestProfileMixin, View):
+
+    def get(self, request, profile_id):
+        profile = self.get_profile()
+        content_type = 'application/octet-stream' if profile['kind'] == CPROFILE else 'text/plain; charset=utf-8'
+        response = HttpResponse(profile['data'], content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{profile_filename(profile)}"'
+        return response
+
+
+# ========================================
+
+
 # Create your views here.
@@ -54,6 +54,9 @@ SITE_ID = 1
 
 
 MIDDLEWARE = [
+    'app.middleware.MetricsMiddleware',
+    'app.middleware.ProfilingMiddleware',
+    'app.middleware.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -95,22 +98,53 @@ EMAIL_SERVER = EMAIL_HOST_USER
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 EMAIL_ADMIN = EMAIL_HOST_USER
 
+# With EMAIL_BATCHING, registration only leaves the user pending and
+# celery-beat flushes pending activation emails every
+# EMAIL_BATCH_FLUSH_INTERVAL seconds, EMAIL_BATCH_SIZE per SMTP connection.
+# EMAIL_BATCH_RATE_LIMIT is in messages per second, 0 for no limit.
+EMAIL_BATCHING = env.bool('EMAIL_BATCHING', default=False)
+EMAIL_BATCH_SIZE = env.int('EMAIL_BATCH_SIZE', default=50)
+EMAIL_BATCH_FLUSH_INTERVAL = env.int('EMAIL_BATCH_FLUSH_INTERVAL', default=30)
+EMAIL_BATCH_RATE_LIMIT = env.float('EMAIL_BATCH_RATE_LIMIT', default=5)
+EMAIL_BATCH_RETRIES = 2
+EMAIL_BATCH_RETRY_DELAY = 1
+EMAIL_BATCH_MAX_ATTEMPTS = 5
+# A batch being sent keeps its users to itself for this long; the users
+# of a flush that died are picked up again afterwards.
+EMAIL_BATCH_CLAIM_TIMEOUT = 60 * 10
+
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 
 CRISPY_TEMPLATE_PACK = "bootstrap5"
 
 WSGI_APPLICATION = 'project.wsgi.application'
 
+# Route the news list and detail pages to their async implementations; turn
+# on when serving project.asgi:application with an ASGI server.
+ASYNC_VIEWS = env.bool('ASYNC_VIEWS', default=False)
+
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# Aliases of read replicas in DATABASES (see app.routers). A client that
+# wrote reads from the primary for DATABASE_REPLICA_STICKY_SECONDS.
+DATABASE_ROUTERS = ['app.routers.PrimaryReplicaRouter']
+DATABASE_REPLICAS = []
+DATABASE_REPLICA_STICKY_SECONDS = env.int('DB_REPLICA_STICKY_SECONDS', default=15)
+DATABASE_REPLICA_PIN_COOKIE = 'use_primary'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
 AUTH_USER_MODEL = "app.User"
 
+# request.user is loaded from the cache and kept there for USER_CACHE_TIMEOUT
+# seconds at most; saving or deleting the user drops it.
+AUTHENTICATION_BACKENDS = ['app.backends.CachedModelBackend']
+USER_CACHE_TIMEOUT = env.int('USER_CACHE_TIMEOUT', default=60 * 15)
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -141,6 +175,13 @@ USE_TZ = True
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 
+# 'django' streams media files from the app (development); 'x-accel' only
+# checks them and lets nginx send the body from an internal location
+# mapped to MEDIA_ROOT at MEDIA_ACCEL_REDIRECT_PREFIX.
+MEDIA_SERVE_MODE = env('MEDIA_SERVE_MODE', default='django')
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+MEDIA_MAX_AGE = 60 * 60 * 24
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.0/howto/static-files/
 
@@ -159,11 +200,124 @@ CELERY_RESULT_BACKEND = 'django-db'
 
 CACHES = {
     "default": {
-        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "BACKEND": "app.metrics.MeteredRedisCache",
         "LOCATION": "redis://redis:6379/1",
-    }
+    },
+    "sessions": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://redis:6379/2",
+    },
 }
 
+# Where sessions are stored: 'db', 'cache' (only in the "sessions" Redis
+# database, lost if Redis is flushed) or 'cached_db' (written to both, read
+# from Redis first).
+SESSION_STORE = env('SESSION_STORE', default='db')
+SESSION_ENGINE = f'django.contrib.sessions.backends.{SESSION_STORE}'
+SESSION_CACHE_ALIAS = 'sessions'
+
 CELERY_CACHE_BACKEND = 'default'
 
+# News.comments_count drift repair, run by celery-beat.
+COMMENT_COUNT_RECONCILE_INTERVAL = env.int('COMMENT_COUNT_RECONCILE_INTERVAL', default=60 * 60)
+COMMENT_COUNT_RECONCILE_BATCH_SIZE = 1000
+# The comment counts on the news index (and its ETag) are refreshed at most
+# this many seconds after a comment is added or deleted.
+COMMENT_COUNT_BUMP_DELAY = env.int('COMMENT_COUNT_BUMP_DELAY', default=60)
+
+# Article views are counted in Redis (app.popularity) and added to News by
+# celery-beat every VIEW_COUNT_FLUSH_INTERVAL seconds. The daily readers
+# and rankings behind the "most read" block on the index are kept
+# VIEW_COUNT_RETENTION_DAYS days; the block is rebuilt every
+# MOST_READ_TIMEOUT seconds.
+VIEW_COUNTING = env.bool('VIEW_COUNTING', default=True)
+VIEW_COUNT_REDIS_URL = env('VIEW_COUNT_REDIS_URL', default='redis://redis:6379/3')
+VIEW_COUNT_FLUSH_INTERVAL = env.int('VIEW_COUNT_FLUSH_INTERVAL', default=60)
+VIEW_COUNT_FLUSH_BATCH_SIZE = 1000
+VIEW_COUNT_RETENTION_DAYS = 8
+MOST_READ_SIZE = 5
+MOST_READ_TIMEOUT = 60
+
+CELERY_BEAT_SCHEDULE = {
+    'reconcile-comment-counts': {
+        'task': 'app.task.reconcile_comment_counts',
+        'schedule': COMMENT_COUNT_RECONCILE_INTERVAL,
+    },
+    'flush-view-counts': {
+        'task': 'app.task.flush_view_counts',
+        'schedule': VIEW_COUNT_FLUSH_INTERVAL,
+    },
+}
+
+if EMAIL_BATCHING:
+    CELERY_BEAT_SCHEDULE['flush-activation-emails'] = {
+        'task': 'app.task.flush_activation_emails',
+        'schedule': EMAIL_BATCH_FLUSH_INTERVAL,
+    }
+
+# Small lookup tables (app.cache.LookupTable) are also kept in each process
+# and rechecked against the shared cache every LOOKUP_CACHE_LOCAL_TIMEOUT
+# seconds, which bounds how long another process serves them stale.
+LOOKUP_CACHE_LOCAL_TIMEOUT = env.int('LOOKUP_CACHE_LOCAL_TIMEOUT', default=10)
+LOOKUP_CACHE_LOCAL_SIZE = 64
+
+# Rendered article lists on the news index; saves invalidate them sooner.
+NEWS_LIST_CACHE_TIMEOUT = 60 * 15
+# Cache-Control max-age of the news index for anonymous readers.
+NEWS_LIST_MAX_AGE = 60
+
+# Server-Timing headers and the Prometheus endpoint at /metrics, which
+# outside DEBUG answers only requests bearing METRICS_TOKEN.
+METRICS_ENABLED = env.bool('METRICS_ENABLED', default=True)
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+# Every process adds its metrics to METRICS_REDIS_URL each
+# METRICS_FLUSH_INTERVAL seconds, so /metrics reports all the workers;
+# empty leaves each process reporting its own.
+METRICS_REDIS_URL = env('METRICS_REDIS_URL', default='redis://redis:6379/4')
+METRICS_FLUSH_INTERVAL = env.int('METRICS_FLUSH_INTERVAL', default=5)
+
+# Request profiles, browsed at /admin/profiles/: cProfile for a
+# PROFILING_SAMPLE_RATE fraction of requests, stack samples (every
+# PROFILING_SAMPLE_INTERVAL seconds) of any request slower than
+# PROFILING_SLOW_THRESHOLD seconds. WSGI requests only.
+PROFILING_ENABLED = env.bool('PROFILING_ENABLED', default=False)
+PROFILING_SAMPLE_RATE = env.float('PROFILING_SAMPLE_RATE', default=0.01)
+PROFILING_SLOW_THRESHOLD = env.float('PROFILING_SLOW_THRESHOLD', default=1.0)
+PROFILING_SAMPLE_INTERVAL = 0.01
+PROFILING_KEEP = 100
+PROFILING_TIMEOUT = 60 * 60 * 24 * 7
+
+# Queries slower than SLOW_QUERY_THRESHOLD seconds go to SLOW_QUERY_LOG as
+# JSON lines; on PostgreSQL a SLOW_QUERY_EXPLAIN_RATE fraction of slow
+# SELECTs also gets EXPLAIN (ANALYZE, BUFFERS), at most once per query shape
+# every SLOW_QUERY_EXPLAIN_INTERVAL seconds. Summary: manage.py slow_queries.
+SLOW_QUERY_LOG_ENABLED = env.bool('SLOW_QUERY_LOG_ENABLED', default=True)
+SLOW_QUERY_THRESHOLD = env.float('SLOW_QUERY_THRESHOLD', default=0.2)
+SLOW_QUERY_EXPLAIN_RATE = env.float('SLOW_QUERY_EXPLAIN_RATE', default=0.1)
+SLOW_QUERY_EXPLAIN_INTERVAL = 60 * 10
+SLOW_QUERY_LOG = env('SLOW_QUERY_LOG', default=str(BASE_DIR / 'slow_queries.log'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'slow_queries': {
+            'class': 'logging.handlers.WatchedFileHandler',
+            'filename': SLOW_QUERY_LOG,
+            'formatter': 'message',
+            'delay': True,
+        },
+    },
+    'loggers': {
+        'app.slow_queries': {
+            'handlers': ['slow_queries'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
+
 
@@ -7,5 +7,18 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+    },
+    # A stand-in read replica: DB_REPLICAS=replica routes reads to a copy of
+    # db.sqlite3 that never catches up, which shows what the stickiness to
+    # the primary covers.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db-replica.sqlite3',
+        'TEST': {'MIRROR': 'default'},
+    },
 }
+DATABASE_REPLICAS = env.list('DB_REPLICAS', default=[])
+
+# Covering indexes (Index.include) only exist on PostgreSQL; SQLite builds
+# them without the INCLUDE columns.
+SILENCED_SYSTEM_CHECKS = ['models.W040']
@@ -10,5 +10,43 @@ DATABASES = {
         'PASSWORD': env('DB_PASSWORD'),
         'HOST': env('DB_HOST'),
         'PORT': env('DB_PORT'),
+        # Also the pool's checkout check, see DB_POOL below.
+        'CONN_HEALTH_CHECKS': True,
     }
-}
\ No newline at end of file
+}
+
+# DB_POOL=True gives each process a psycopg connection pool of
+# DB_POOL_MIN_SIZE to DB_POOL_MAX_SIZE connections; a request waits at most
+# DB_POOL_TIMEOUT seconds for one, and the wait shows up in the
+# news_db_pool_* metrics. Django's own CONN_HEALTH_CHECKS test is skipped
+# for pooled connections, but Django 5.1 hands psycopg_pool
+# ConnectionPool.check_connection as the pool's ``check`` callback when
+# CONN_HEALTH_CHECKS is on, so a connection that died idle (a Postgres
+# restart) is replaced at checkout instead of failing the request's first
+# query. It must not be repeated in the pool options: Django passes
+# ``check`` itself and a second one is a TypeError.
+# Celery workers run with DB_POOL=False (see docker-compose.yml), as every
+# prefork child would hold a pool of its own; they keep connections for
+# DB_CONN_MAX_AGE seconds.
+if env.bool('DB_POOL', default=False):
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': env.int('DB_POOL_MIN_SIZE', default=2),
+            'max_size': env.int('DB_POOL_MAX_SIZE', default=10),
+            'timeout': env.float('DB_POOL_TIMEOUT', default=10),
+        },
+    }
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = env.int('DB_CONN_MAX_AGE', default=0)
+
+# Read replicas, as DB_REPLICA_HOSTS=replica-1,replica-2:5433. They share
+# the primary's database name and credentials.
+for number, host in enumerate(env.list('DB_REPLICA_HOSTS', default=[]), 1):
+    host, _, port = host.partition(':')
+    DATABASES[f'replica_{number}'] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port or env('DB_PORT'),
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
@@ -15,20 +15,27 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 
-from django.conf.urls.static import static
 from .settings import base
 from django.contrib.auth.views import LogoutView
+from app.media import serve_media
+from app.metrics import metrics_view
+from app import views
 
 
 urlpatterns = [
+    path('admin/profiles/', views.RequestProfileListView.as_view(), name='request_profiles'),
+    path('admin/profiles/<str:profile_id>/', views.RequestProfileDetailView.as_view(), name='request_profile'),
+    path(
+        'admin/profiles/<str:profile_id>/download/',
+        views.RequestProfileDownloadView.as_view(), name='request_profile_download',
+    ),
     path('admin/', admin.site.urls),
     path('news/', include('app.urls')),
     path('logout/', LogoutView.as_view(), name='logout' ),
     path('captcha/', include('captcha.urls')),
+    path('metrics', metrics_view, name='metrics'),
+    re_path(r'^%s(?P<path>.*)$' % base.MEDIA_URL.lstrip('/'), serve_media, name='media'),
 ]
 
-
-
-urlpatterns += static(base.MEDIA_URL, document_root=base.MEDIA_ROOT)